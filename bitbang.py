@@ -6,23 +6,44 @@ Bit Bang JTAG Driver - JTAG via simple single bit IO lines
 #------------------------------------------------------------------------------
 
 import time
+import string
 import bits
 import tap
+import driver
 
 #------------------------------------------------------------------------------
 
 _TRST_TIME = 0.01
 
+# tdo samples (0/1 bytes) -> bit characters
+_bit_chars = string.maketrans('\x00\x01', '01')
+
 #------------------------------------------------------------------------------
 
-class jtag_driver:
+class jtag_driver(driver.jtag_driver):
 
     def __init__(self, io):
         self.io = io
-        self.tap = tap.tap()
+        # adapters with jtag_port()/jtag_seq() take whole scans as port value sequences
+        self.vector = hasattr(io, 'jtag_seq')
+        if self.vector:
+            self.build_tables()
         self.state_reset()
-        self.sir_end_state = 'IDLE'
-        self.sdr_end_state = 'IDLE'
+        self.sir_end_state = tap.IDLE
+        self.sdr_end_state = tap.IDLE
+
+    def build_tables(self):
+        """build the port value tables for the adapter"""
+        port = self.io.jtag_port
+        # pairs[tms][tdi] is the port values for a tck cycle
+        self.pairs = [[chr(port(0, tms, tdi)) + chr(port(1, tms, tdi)) for tdi in (0, 1)] for tms in (0, 1)]
+        # tdi bit characters -> port values for the low and high halves of the cycle (tms = 0)
+        self.tdi_lo = string.maketrans('01', chr(port(0, 0, 0)) + chr(port(0, 0, 1)))
+        self.tdi_hi = string.maketrans('01', chr(port(1, 0, 0)) + chr(port(1, 0, 1)))
+
+    def tms_seq(self, tms):
+        """return the port values to clock out a tms bit tuple"""
+        return bytearray(''.join([self.pairs[b][0] for b in tms]))
 
     def clock_tms(self, tms):
         """clock out a tms bit"""
@@ -46,18 +67,39 @@ class jtag_driver:
 
     def state_x(self, dst):
         """change the TAP state from self.state to dst"""
-        bits = self.tap.tms(self.state, dst)
+        bits = tap.tms_table[self.state][dst]
         if not bits:
             # no state change
             assert self.state == dst
             return
-        [self.clock_tms(b) for b in bits]
+        if self.vector:
+            self.io.jtag_seq(self.tms_seq(bits), False)
+        else:
+            [self.clock_tms(b) for b in bits]
         self.state = dst
 
     def state_reset(self):
         """from *any* state go to the reset state"""
-        self.state = '*'
-        self.state_x('RESET')
+        if self.vector:
+            self.io.jtag_seq(self.tms_seq(tap.tms_reset), False)
+        else:
+            [self.clock_tms(b) for b in tap.tms_reset]
+        self.state = tap.RESET
+
+    def clock(self, n, secs = 0.0):
+        """clock tck n times in the current (stable) state, taking at least secs seconds"""
+        t = time.time()
+        # tms = 1 holds the reset state, tms = 0 holds the others
+        tms = (0, 1)[self.state == tap.RESET]
+        if self.vector:
+            if n:
+                self.io.jtag_seq(bytearray(self.pairs[tms][0] * n), False)
+        else:
+            for i in xrange(n):
+                self.clock_tms(tms)
+        t = secs - (time.time() - t)
+        if t > 0:
+            time.sleep(t)
 
     def shift_data(self, tdi, tdo):
         """
@@ -65,31 +107,71 @@ class jtag_driver:
         tdi - bit buffer of data to be written to the JTAG TDI pin
         tdo - bit buffer for the data read from the JTAG TDO pin (optional)
         """
+        # shifting a bit at a time is cheap for bits (a long), not for bytebits/rope
+        wr = bits.bits(tdi.n, tdi.val)
         if tdo is None:
-            for i in range(tdi.n - 1):
-                self.clock_data_o(0, tdi.shr())
+            for i in range(wr.n - 1):
+                self.clock_data_o(0, wr.shr())
             # last bit
-            self.clock_data_o(1, tdi.shr())
+            self.clock_data_o(1, wr.shr())
         else:
-            tdo.zeroes(tdi.n)
-            for i in range(tdi.n - 1):
-                tdo.shr(self.clock_data_io(0, tdi.shr()))
+            rd = bits.bits()
+            rd.zeroes(wr.n)
+            for i in range(wr.n - 1):
+                rd.shr(self.clock_data_io(0, wr.shr()))
             # last bit
-            tdo.shr(self.clock_data_io(1, tdi.shr()))
+            rd.shr(self.clock_data_io(1, wr.shr()))
+            tdo.set(rd.n, rd.get())
         # Note: we are now in the IR/DR EXIT1 state
 
+    def vector_scan(self, shift, tdi, tdo, end_state):
+        """
+        do a scan as one sequence of port values
+        shift - the shift state (tap.IRSHIFT or tap.DRSHIFT)
+        tdi - bit buffer of data to be written to the JTAG TDI pin
+        tdo - bit buffer for the data read from the JTAG TDO pin (optional)
+        end_state - leave the TAP state machine in this state
+        """
+        entry = tap.tms_table[self.state][shift]
+        # the last bit of data takes us to exit1 (the state after shift with tms = 1)
+        exit = tap.tms_table[tap.next_state[shift][1]][end_state]
+        n = tdi.n
+        # tdi bit characters, lsb first
+        s = bin(tdi.val)[2:].zfill(n)[::-1]
+        # tms = 0 for all but the last bit
+        body = bytearray(2 * (n - 1))
+        body[0::2] = s[:-1].translate(self.tdi_lo)
+        body[1::2] = s[:-1].translate(self.tdi_hi)
+        seq = self.tms_seq(entry)
+        seq.extend(body)
+        seq.extend(self.pairs[1][s[-1] == '1'])
+        seq.extend(self.tms_seq(exit))
+        rd = self.io.jtag_seq(seq, tdo is not None)
+        self.state = end_state
+        if tdo is not None:
+            e = len(entry)
+            s = str(rd[e:e + n]).translate(_bit_chars)[::-1]
+            tdo.zeroes(n)
+            tdo.val = int(s, 2)
+
     def scan_ir(self, tdi, tdo = None):
         """write (and possibly read) a bit stream through the IR in the JTAG chain"""
-        self.state_x('IRSHIFT')
+        if self.vector:
+            self.vector_scan(tap.IRSHIFT, tdi, tdo, self.sir_end_state)
+            return
+        self.state_x(tap.IRSHIFT)
         self.shift_data(tdi, tdo)
-        self.state = 'IREXIT1'
+        self.state = tap.IREXIT1
         self.state_x(self.sir_end_state)
 
     def scan_dr(self, tdi, tdo = None):
         """write (and possibly read) a bit stream through the DR in the JTAG chain"""
-        self.state_x('DRSHIFT')
+        if self.vector:
+            self.vector_scan(tap.DRSHIFT, tdi, tdo, self.sdr_end_state)
+            return
+        self.state_x(tap.DRSHIFT)
         self.shift_data(tdi, tdo)
-        self.state = 'DREXIT1'
+        self.state = tap.DREXIT1
         self.state_x(self.sdr_end_state)
 
     def system_reset(self):
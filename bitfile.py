@@ -171,12 +171,15 @@ def load(filename, smap):
     print('bitstream: %d bytes' % len(bitstream))
     # write out the bitstream
     progress = utils.progress(100, len(bitstream))
-    i = 0
     smap.start()
-    for byte in bitstream:
-        smap.wr(ord(byte))
-        progress.update(i)
-        i += 1
+    if hasattr(smap, 'wr_block'):
+        smap.wr_block(bitstream, progress)
+    else:
+        i = 0
+        for byte in bitstream:
+            smap.wr(ord(byte))
+            progress.update(i)
+            i += 1
     smap.finish()
     progress.erase()
 
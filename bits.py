@@ -7,6 +7,29 @@ Bit Buffer Operations
 
 import random
 import array
+import binascii
+
+#-----------------------------------------------------------------------------
+# fast conversion between longs and lsb first byte buffers
+# (hex conversion of a long is linear, byte at a time shifting is not)
+
+def _val2bytes(n, val):
+    """return a bytearray with the n bits of val, lsb first"""
+    nbytes = (n + 7) >> 3
+    if nbytes == 0:
+        return bytearray()
+    val &= ((1 << n) - 1)
+    b = bytearray(binascii.unhexlify('%0*x' % (nbytes * 2, val)))
+    b.reverse()
+    return b
+
+def _bytes2val(b):
+    """return the value of an lsb first byte buffer"""
+    if len(b) == 0:
+        return 0
+    b = bytearray(b)
+    b.reverse()
+    return int(binascii.hexlify(b), 16)
 
 #-----------------------------------------------------------------------------
 
@@ -91,26 +114,13 @@ class bits:
     def get(self):
         """return a byte array of the bits"""
         a = array.array('B')
-        n = self.n
-        val = self.val
-        while n > 0:
-            if n > 8:
-                a.append(val & 255)
-                val >>= 8
-                n -= 8
-            else:
-                val &= (1 << n) - 1
-                a.append(val)
-                break
+        a.fromstring(str(_val2bytes(self.n, self.val)))
         return a
 
     def set(self, n, a):
         """set the bits from a byte array"""
-        self.val = 0
         self.n = n
-        for i in range(len(a) - 1, -1, -1):
-            self.val <<= 8
-            self.val |= a[i]
+        self.val = _bytes2val(a)
 
     def scan(self, format):
         """using the format tuple, scan the buffer and return a tuple of values"""
@@ -154,3 +164,306 @@ class bits:
 
 #-----------------------------------------------------------------------------
 
+class bytebits(object):
+    """
+    Bit buffer backed by a bytearray.
+    Bit 0 of the buffer is bit 0 of byte 0, the same ordering as bits.get().
+    The bits above n in the last byte are always kept as 0, so the byte
+    array can be handed to (and taken from) the io layer without conversion.
+    """
+
+    def __init__(self, n = 0, val = 0):
+        self.n = n
+        self.data = _val2bytes(n, val)
+
+    def _get_data(self):
+        if self.low:
+            # join the byte aligned appends (the newest are the lowest bytes)
+            data = bytearray()
+            for b in reversed(self.low):
+                data.extend(b)
+            data.extend(self._data)
+            self._data = data
+            self.low = []
+        return self._data
+
+    def _set_data(self, data):
+        self._data = data
+        self.low = []
+
+    data = property(_get_data, _set_data)
+
+    def _get_val(self):
+        return _bytes2val(self.data)
+
+    def _set_val(self, val):
+        self.data = _val2bytes(self.n, val)
+
+    val = property(_get_val, _set_val)
+
+    def _mask(self):
+        """zero the unused bits in the last byte"""
+        k = self.n & 7
+        if k:
+            self.data[-1] &= (1 << k) - 1
+
+    def clear(self):
+        """remove any contents"""
+        self.n = 0
+        self.data = bytearray()
+
+    def ones(self, n):
+        """set n bits to 1"""
+        self.n = n
+        self.data = bytearray('\xff' * ((n + 7) >> 3))
+        self._mask()
+
+    def zeroes(self, n):
+        """set n bits to 0"""
+        self.n = n
+        self.data = bytearray((n + 7) >> 3)
+
+    def random(self, n):
+        """set n bits to random values"""
+        self.n = n
+        self.data = bytearray([random.randint(0, 255) for i in xrange((n + 7) >> 3)])
+        self._mask()
+
+    def _append_bytes(self, n, b):
+        """append n bits from a byte array to the bit buffer"""
+        if n & 7 == 0:
+            # byte aligned - the new bits are the low bytes of the buffer,
+            # they are kept aside until the data is needed (no copy per append)
+            self.low.append(b[:n >> 3])
+            self.n += n
+        else:
+            val = (self.val << n) | (_bytes2val(b) & ((1 << n) - 1))
+            self.n += n
+            self.val = val
+
+    def append(self, bits):
+        """append a bit buffer to the bit buffer"""
+        if isinstance(bits, bytebits):
+            self._append_bytes(bits.n, bits.data)
+        else:
+            self.append_val(bits.n, bits.val)
+
+    def append_val(self, n, val):
+        """append n bits from val to the bit buffer"""
+        self._append_bytes(n, _val2bytes(n, val))
+
+    def append_ones(self, n):
+        """append n 1 bits to the bit buffer"""
+        self._append_bytes(n, bytearray('\xff' * ((n + 7) >> 3)))
+
+    def append_zeroes(self, n):
+        """append n 0 bits to the bit buffer"""
+        self._append_bytes(n, bytearray((n + 7) >> 3))
+
+    def append_str(self, s):
+        """append a bit string to the bit buffer"""
+        self.append_val(len(s), int(s, 2))
+
+    def set_hex(self, n, s):
+        """set n bits from a hex string (msb first, as in an svf file)"""
+        if len(s) & 1:
+            s = '0' + s
+        b = bytearray(binascii.unhexlify(s))
+        b.reverse()
+        nbytes = (n + 7) >> 3
+        if len(b) < nbytes:
+            b.extend(bytearray(nbytes - len(b)))
+        else:
+            del b[nbytes:]
+        self.n = n
+        self.data = b
+        self._mask()
+
+    def drop_lsb(self, n):
+        """drop the least significant n bits"""
+        if n >= self.n:
+            self.clear()
+        elif n & 7 == 0:
+            del self.data[:n >> 3]
+            self.n -= n
+        else:
+            val = self.val >> n
+            self.n -= n
+            self.val = val
+
+    def drop_msb(self, n):
+        """drop the most significant n bits"""
+        if n >= self.n:
+            self.clear()
+        else:
+            self.n -= n
+            del self.data[(self.n + 7) >> 3:]
+            self._mask()
+
+    def shr(self, bit_in = 0):
+        """shift right (this converts the whole buffer, use bits for bit at a time shifting)"""
+        val = self.val
+        bit_out = val & 1
+        val >>= 1
+        val |= (bit_in << (self.n - 1))
+        self.val = val
+        return bit_out
+
+    def get(self):
+        """return the bytearray holding the bits (not a copy)"""
+        return self.data
+
+    def set(self, n, a):
+        """set the bits from a byte array (a bytearray is used as is, not copied)"""
+        if not isinstance(a, bytearray):
+            a = bytearray(a)
+        nbytes = (n + 7) >> 3
+        if len(a) < nbytes:
+            a.extend(bytearray(nbytes - len(a)))
+        elif len(a) > nbytes:
+            del a[nbytes:]
+        self.n = n
+        self.data = a
+        self._mask()
+
+    def view(self):
+        """return a memoryview of the buffer bytes"""
+        return memoryview(self.data)
+
+    def tobytes(self):
+        """return the buffer bytes as a string"""
+        return str(self.data)
+
+    def scan(self, format):
+        """using the format tuple, scan the buffer and return a tuple of values"""
+        l = []
+        val = self.val
+        format_list = list(format)
+        format_list.reverse()
+        for n in format_list:
+            mask = (1 << n) - 1
+            l.append(val & mask)
+            val >>= n
+        l.reverse()
+        return tuple(l)
+
+    def __and__(self, x):
+        return bytebits(min(self.n, x.n), self.val & x.val)
+
+    def __eq__(self, x):
+        if isinstance(x, bytebits):
+            return (self.n == x.n) and (self.data == x.data)
+        return (self.n == x.n) and (self.val == x.val)
+
+    def __ne__(self, x):
+        return not self.__eq__(x)
+
+    def __str__(self):
+        return '(%d) %x' % (self.n, self.val)
+
+    def __len__(self):
+        return self.n
+
+    def bit_str(self):
+        """return a bit string for the buffer"""
+        if self.n == 0:
+            return ''
+        return bin(self.val)[2:].zfill(self.n)
+
+#-----------------------------------------------------------------------------
+class rope(object):
+    """
+    Bit buffer built from segments.
+    Appends are O(1): the segments are only joined when the bits are needed.
+    Drivers that can stream segments use segments() and never join them.
+    """
+
+    def __init__(self):
+        self.n = 0
+        # (n, bit, buf) in append order, bit is 0/1 for a fill, None for data
+        self.segs = []
+        self.joined = None
+
+    def _add(self, n, bit, buf):
+        if n > 0:
+            self.segs.append((n, bit, buf))
+            self.n += n
+            self.joined = None
+
+    def append(self, bits):
+        """append a bit buffer (by reference) to the rope"""
+        self._add(bits.n, None, bits)
+
+    def append_val(self, n, val):
+        """append n bits from val to the rope"""
+        self._add(n, None, bytebits(n, val))
+
+    def append_ones(self, n):
+        """append n 1 bits to the rope"""
+        self._add(n, 1, None)
+
+    def append_zeroes(self, n):
+        """append n 0 bits to the rope"""
+        self._add(n, 0, None)
+
+    def segments(self):
+        """return the (n, bit, buf) segments in shift order (lsb first)"""
+        return reversed(self.segs)
+
+    def join(self):
+        """join the segments and return a single bytebits buffer"""
+        if self.joined is None:
+            x = bytebits()
+            if all([n & 7 == 0 for (n, bit, buf) in self.segs[1:]]):
+                # byte aligned - concatenate the segment bytes
+                data = bytearray()
+                for (n, bit, buf) in self.segments():
+                    nbytes = (n + 7) >> 3
+                    if bit is None:
+                        data.extend(buf.get()[:nbytes])
+                    else:
+                        data.extend(('\x00', '\xff')[bit] * nbytes)
+                x.set(self.n, data)
+            else:
+                val = 0
+                shift = 0
+                for (n, bit, buf) in self.segments():
+                    mask = (1 << n) - 1
+                    if bit is None:
+                        val |= (buf.val & mask) << shift
+                    elif bit:
+                        val |= mask << shift
+                    shift += n
+                x.n = self.n
+                x.val = val
+            self.joined = x
+        return self.joined
+
+    def _get_val(self):
+        return self.join().val
+
+    val = property(_get_val)
+
+    def get(self):
+        """return a byte array of the bits"""
+        return self.join().get()
+
+    def shr(self, bit_in = 0):
+        """shift right (this converts the whole buffer, use bits for bit at a time shifting)"""
+        return self.join().shr(bit_in)
+
+    def scan(self, format):
+        """using the format tuple, scan the buffer and return a tuple of values"""
+        return self.join().scan(format)
+
+    def bit_str(self):
+        """return a bit string for the buffer"""
+        return self.join().bit_str()
+
+    def __str__(self):
+        return str(self.join())
+
+    def __len__(self):
+        return self.n
+
+#-----------------------------------------------------------------------------
@@ -72,6 +72,12 @@ class board:
         chain.scan(jtag.IDCODE_XC2C32A)
         self.cpld = cpld.xc2c32a(chain)
 
+    def tune(self):
+        """measure the ft2232 and save its tuning profiles (resets the cpld TAP)"""
+        driver = self.cpld.jtag.driver
+        for workload in ('bulk', 'interactive'):
+            driver.tune(workload)
+
     def load_cpld(self, filename):
         """configure the cpld with an svf file"""
         self.cpld.configure(''.join((_file_path, filename)))
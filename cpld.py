@@ -28,21 +28,34 @@ class cpld:
         self.jtag.rw_dr(wr, rd)
         return rd.scan((n,))[0]
 
+    def rd_reg(self, ir, n):
+        """write the instruction register then read n bits from the data register"""
+        # queue both scans so a batching driver sends them in one usb write
+        self.jtag.queue_wr_ir(bits.bits(self._IR_LEN, ir))
+        rd = self.jtag.queue_rw_dr(bits.bits(n))
+        self.jtag.flush()
+        return rd.result().scan((n,))[0]
+
     def rd_usercode(self):
         """read and return the jtag usercode"""
-        self.wr_ir(self._IR_USERCODE)
-        return self.rd_dr(self._DR_USERCODE_LEN)
+        return self.rd_reg(self._IR_USERCODE, self._DR_USERCODE_LEN)
 
     def rd_idcode(self):
         """read and return the jtag idcode"""
-        self.wr_ir(self._IR_IDCODE)
-        return self.rd_dr(self._DR_IDCODE_LEN)
+        return self.rd_reg(self._IR_IDCODE, self._DR_IDCODE_LEN)
 
     def configure(self, filename):
         """configure the device with an svf file"""
         print('configuring cpld with %s' % filename)
-        f = svf.svf(filename, self.jtag)
-        f.playback()
+        f = svf.svf(filename, self.jtag, True)
+        # configuration is long scans, use the bulk settings meanwhile
+        driver = self.jtag.driver
+        workload = driver.workload
+        driver.set_workload('bulk')
+        try:
+            f.playback_compiled()
+        finally:
+            driver.set_workload(workload)
 
     def __str__(self):
         s = []
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+"""
+JTAG Driver Base Class
+
+A driver declares what it can do with the capability attributes.
+jtag.jtag and svf.svf look at these to pick the fastest way to use it.
+"""
+#------------------------------------------------------------------------------
+
+import time
+
+#------------------------------------------------------------------------------
+
+class Error(Exception):
+    pass
+
+#------------------------------------------------------------------------------
+
+class jtag_driver:
+
+    # capabilities
+    queued = False          # commands are queued, later()/sync() complete them
+    async_read = False      # read scans can be left outstanding until sync()
+    recordable = False      # record()/record_stop()/play() are supported
+    idle_clock = False      # clock() is cheap enough to use for long waits,
+                            # and the reads allow for the time queued clocks take
+    static_tdi = False      # constant tdi runs are sent without the data
+    max_frequency = None    # maximum tck frequency (Hz), None if unknown
+
+    # current tck frequency (Hz), None if unknown
+    frequency = None
+    # batch the queued commands until sync(), async_read drivers
+    # also leave the read scans outstanding (queued drivers only)
+    deferred = False
+    # the kind of work the driver is set up for (interactive or bulk)
+    workload = 'interactive'
+
+    def not_supported(self, what):
+        raise Error, '%s: %s is not supported' % (self, what)
+
+    def adapter(self):
+        """return a string naming the adapter (with its serial number if the driver knows it)"""
+        return str(self)
+
+    def later(self, fn):
+        """call fn once the queued reads have been done"""
+        fn()
+
+    def sync(self):
+        """complete any queued commands"""
+        pass
+
+    def delay(self, secs):
+        """wait for secs seconds after the queued commands have been done"""
+        self.sync()
+        time.sleep(secs)
+
+    def set_frequency(self, f):
+        """set the tck frequency (at most f Hz), return the actual frequency (None if unknown)"""
+        return self.frequency
+
+    def set_workload(self, workload):
+        """set the driver up for interactive (register access) or bulk (long scans) work"""
+        self.workload = workload
+
+    def clock(self, n, secs = 0.0):
+        """clock tck n times in the current (stable) state, taking at least secs seconds"""
+        self.not_supported('clock')
+
+    def state_x(self, dst):
+        """change the TAP state from self.state to dst"""
+        self.not_supported('state_x')
+
+    def state_reset(self):
+        """from *any* state go to the reset state"""
+        self.not_supported('state_reset')
+
+    def scan_ir(self, tdi, tdo = None):
+        """write (and possibly read) a bit stream through the IR in the JTAG chain"""
+        self.not_supported('scan_ir')
+
+    def scan_dr(self, tdi, tdo = None):
+        """write (and possibly read) a bit stream through the DR in the JTAG chain"""
+        self.not_supported('scan_dr')
+
+    def test_reset(self, val):
+        """control the test reset line"""
+        pass
+
+    def reset_jtag(self):
+        """reset the TAP of all JTAG devices in the chain"""
+        self.not_supported('reset_jtag')
+
+    def __str__(self):
+        """return a string describing the device"""
+        return 'jtag driver'
+
+#------------------------------------------------------------------------------
@@ -12,15 +12,32 @@ so I've only borrowed the ftdi specific portions.
 #-----------------------------------------------------------------------------
 
 import time
+import os
+import re
+import math
 import array
 import sys
 import tap
+import utils
+import driver
 from ftdi import Ftdi
 
 #------------------------------------------------------------------------------
 
 _TRST_TIME = 0.01
 _READ_RETRIES = 4
+_DIRECT_WRITE_SIZE = 4096 # payloads of this size or more bypass the write buffer
+_WRITE_DEPTH = 2 # usb writes queued behind the one being sent
+
+# adapter tuning profiles, one file per adapter serial number
+_PROFILE_DIR = os.path.join(os.path.expanduser('~'), '.pyxs', 'ft2232')
+_PROFILE_MAGIC = 'FTPF'
+_WORKLOADS = ('interactive', 'bulk')
+
+# tuning measurements
+_TUNE_CHUNKSIZES = (512, 4096, 16384, 65536)
+_TUNE_ROUNDS = 32                     # round trips per chunk size measurement
+_TUNE_BYTES = 256 << 10               # bytes shifted per throughput measurement
 
 #------------------------------------------------------------------------------
 # JTAG/GPIO Lines in MPSSE Mode
@@ -50,6 +67,14 @@ _MPSSE_LSB       = 0x08   # LSB first
 _MPSSE_DO_WRITE  = 0x10   # Write TDI/DO
 _MPSSE_DO_READ   = 0x20   # Read TDO/DI
 _MPSSE_WRITE_TMS = 0x40   # Write TMS/CS
+_MPSSE_CLK_BITS  = 0x8e   # Clock 1..8 bits, no data (FT2232H/FT4232H)
+_MPSSE_CLK_BYTES = 0x8f   # Clock 1..65536 bytes (x8 bits), no data (FT2232H/FT4232H)
+
+_MAX_BYTES = 65536        # maximum byte count for an MPSSE command
+
+# constant tdi runs (bytes) shorter than this are sent as data
+_STATIC_MIN = 16
+_static_runs = re.compile('\x00{%d,}|\xff{%d,}' % (_STATIC_MIN, _STATIC_MIN))
 
 #-----------------------------------------------------------------------------
 # MSB/LSB for 16 bit values
@@ -72,27 +97,124 @@ def tms_mpsse(bits):
     # len = n means clock out n + 1 bits
     return (n - 1, x & 127)
 
+_TMS_CMD = _MPSSE_WRITE_TMS | _MPSSE_BITMODE | _MPSSE_LSB | _MPSSE_WRITE_NEG
+
+def _tms_cmds(bits):
+    """return the mpsse commands for a tms bit sequence"""
+    cmds = []
+    for i in range(0, len(bits), 7):
+        tms = tms_mpsse(bits[i:i + 7])
+        cmds.extend((_TMS_CMD, tms[0], tms[1]))
+    return tuple(cmds)
+
+def _tms_last(bits):
+    if 0 < len(bits) <= 7:
+        return tms_mpsse(bits)
+    return None
+
+# pre-packed mpsse commands for all state transitions
+_tms_table = tap.table(_tms_cmds)
+_tms_reset = _tms_cmds(tap.tms_reset)
+# mpsse (len, bits) tuples for leaving a shift state with the last data bit
+_tms_last_table = tap.table(_tms_last)
+
+#------------------------------------------------------------------------------
+
+def _dispatch(handlers, rd):
+    """pass the read data to the read handlers, run the callbacks"""
+    ofs = 0
+    for (n, fn) in handlers:
+        if n:
+            fn(rd[ofs:ofs + n])
+            ofs += n
+        else:
+            fn()
+
+def _tdo_decoder(tdo, n, io_bits, tms_len):
+    """return a read handler that converts scan read data into the tdo bit buffer"""
+    def decode(rd):
+        if io_bits:
+            # the n partial bits are in the top n bits of the byte
+            # move them down to the bottom
+            rd[-2] >>= (8 - io_bits)
+        # get the last bit from the tms response byte (last byte)
+        last_bit = (rd[-1] >> (7 - tms_len)) & 1
+        last_bit <<= io_bits
+        # add the last bit
+        if io_bits:
+            # drop the tms response byte
+            del rd[-1]
+            # or it onto the io_bits byte
+            rd[-1] |= last_bit
+        else:
+            # replace the tms response byte
+            rd[-1] = last_bit
+        # copy to the bit buffer
+        tdo.set(n, rd)
+    return decode
+
+#------------------------------------------------------------------------------
+
+class mpsse_block:
+    """a recorded block of mpsse commands"""
+
+    def __init__(self):
+        self.data = None    # mpsse command bytes
+        self.read_len = 0   # number of bytes read back by the commands
+        self.handlers = []  # (nbytes, fn) read handlers and callbacks
+        self.delay = 0.0    # delay after the block (seconds)
+        self.clock_time = 0.0 # time taken by the tck clocks of the block (seconds)
+
 #------------------------------------------------------------------------------
 
-class jtag_driver:
+class jtag_driver(driver.jtag_driver):
+
+    queued = True
+    async_read = True
+    recordable = True
 
-    def __init__(self, vendor, product, interface):
+    def __init__(self, vendor, product, interface, workload = 'interactive'):
         self.ftdi = Ftdi()
         try:
-            self.ftdi.open_mpsse(vendor, product, interface)
+            self.frequency = self.ftdi.open_mpsse(vendor, product, interface)
         except IOError as e:
             print "ft2232 jtag driver: %s" % str(e)
             self.ftdi = None
             sys.exit(0)
+        # usb writes are done by a background thread
+        self.ftdi.set_async_writes(_WRITE_DEPTH)
+        self.max_frequency = self.ftdi.frequency_max
+        # the h parts have clock only commands
+        self.idle_clock = self.ftdi.type in Ftdi.HISPEED_DEVICES
+        # so constant tdi writes don't need the data
+        self.static_tdi = self.idle_clock
         self.wrbuf = array.array('B')
+        # the write buffer is sent once it holds a tx fifo of commands
+        self.tx_size = self.ftdi.fifo_sizes[0]
+        # read handlers and callbacks for the queued commands
+        self.pending = []
+        self.pending_bytes = 0
+        # time the queued tck clocks take, the reads allow for it
+        self.clock_time = 0.0
+        # recorded mpsse program (None when not recording)
+        self.program = None
         self.gpio_init()
-        self.tap = tap.tap()
         self.state_reset()
-        self.sir_end_state = 'IDLE'
-        self.sdr_end_state = 'IDLE'
+        self.sir_end_state = tap.IDLE
+        self.sdr_end_state = tap.IDLE
+        # the settings used when there is no tuning profile
+        self.default_profile = {
+            'read_chunksize': self.ftdi.read_data_get_chunksize(),
+            'write_chunksize': self.ftdi.write_data_get_chunksize(),
+            'tx_size': self.ftdi.fifo_sizes[0],
+        }
+        # use the tuning profile for the adapter (see tune())
+        self.workload = None
+        self.set_workload(workload)
 
     def __del__(self):
         if self.ftdi:
+            self.flush()
             self.ftdi.close()
 
     def __str__(self):
@@ -101,6 +223,9 @@ class jtag_driver:
 
     def flush(self):
         """flush the write buffer to the ft2232"""
+        if self.program is not None:
+            # recording - keep buffering
+            return
         if len(self.wrbuf) > 0:
             self.ftdi.write_data(self.wrbuf)
             del self.wrbuf[0:]
@@ -108,25 +233,480 @@ class jtag_driver:
     def write(self, buf, flush = False):
         """queue write data to send to ft2232"""
         self.wrbuf.extend(buf)
-        if flush:
+        if flush or len(self.wrbuf) >= self.tx_size:
             self.flush()
 
-    def state_x(self, dst):
-        """change the TAP state from self.state to dst"""
-        bits = self.tap.tms(self.state, dst)
-        if not bits:
+    def write_buffer(self, buf, n, ofs = 0):
+        """queue n bytes of a buffer (from ofs) without slicing a copy of it"""
+        if n >= _DIRECT_WRITE_SIZE and self.program is None:
+            # large payloads go straight to the ft2232
+            self.flush()
+            self.ftdi.write_data(buffer(buf, ofs, n))
+        else:
+            self.wrbuf.fromstring(buffer(buf, ofs, n))
+            if len(self.wrbuf) >= self.tx_size:
+                self.flush()
+
+    def clocking(self, n):
+        """account for n tck clocks in the queued commands"""
+        self.clock_time += float(n) / self.frequency
+
+    def read(self, n, wait):
+        """
+        read n bytes, the queued commands may take another wait seconds to
+        get to the reads (long runs of clocks send nothing back meanwhile)
+        """
+        deadline = time.time() + wait
+        rd = self.ftdi.read_data_bytes(n, _READ_RETRIES)
+        while len(rd) < n:
+            late = time.time() > deadline
+            rd.extend(self.ftdi.read_data_bytes(n - len(rd), _READ_RETRIES))
+            if late:
+                break
+        return rd
+
+    def read_later(self, n, fn):
+        """queue a handler for n bytes of read data"""
+        self.pending.append((n, fn))
+        self.pending_bytes += n
+
+    def done(self):
+        """end of an operation - send the queued commands unless they are being batched"""
+        if not self.deferred:
+            self.flush()
+
+    def later(self, fn):
+        """call fn once the queued reads have been done"""
+        if self.pending:
+            self.pending.append((0, fn))
+        else:
+            fn()
+
+    def sync(self):
+        """flush all queued commands, do the queued reads and run the handlers"""
+        if self.program is not None:
+            # recording - reads happen at playback
+            return
+        handlers = self.pending
+        self.pending = []
+        if self.pending_bytes:
+            # make the ft2232 flush its data back to the PC
+            self.write((Ftdi.SEND_IMMEDIATE,), True)
+            rd = self.read(self.pending_bytes, self.clock_time)
+            self.pending_bytes = 0
+        else:
+            self.flush()
+            rd = None
+        self.clock_time = 0.0
+        _dispatch(handlers, rd)
+
+    def make_room(self, n):
+        """do the oldest queued reads until there is room for n more bytes in the rx fifo"""
+        rx_size = self.ftdi.fifo_sizes[1]
+        if self.pending_bytes + n <= rx_size:
+            return
+        if self.program is not None:
+            # recording - start a new block
+            self.end_block()
+            return
+        # read just enough, the newer commands keep the ft2232 busy meanwhile
+        i = 0
+        nbytes = 0
+        while self.pending_bytes - nbytes + n > rx_size:
+            nbytes += self.pending[i][0]
+            i += 1
+        # include any callbacks that follow
+        while i < len(self.pending) and self.pending[i][0] == 0:
+            i += 1
+        handlers = self.pending[:i]
+        del self.pending[:i]
+        self.pending_bytes -= nbytes
+        # make the ft2232 flush its data back to the PC
+        self.write((Ftdi.SEND_IMMEDIATE,), True)
+        # (the oldest reads may not need all of the clock time)
+        rd = self.read(nbytes, self.clock_time)
+        _dispatch(handlers, rd)
+
+    def delay(self, secs):
+        """wait for secs seconds after the queued commands have been done"""
+        # read back a byte, the commands have been done once it arrives
+        self.make_room(1)
+        self.write((Ftdi.GET_BITS_LOW,))
+        self.read_later(1, lambda rd: None)
+        if self.program is not None:
+            self.end_block(secs)
+            return
+        self.sync()
+        time.sleep(secs)
+
+    def end_block(self, delay = 0.0):
+        """end the current block of the recorded program"""
+        if len(self.wrbuf) == 0 and not self.pending:
+            # nothing to do - merge the delay with the previous block
+            if self.program:
+                self.program[-1].delay += delay
+                return
+        if self.pending_bytes:
+            self.write((Ftdi.SEND_IMMEDIATE,))
+        blk = mpsse_block()
+        blk.data = self.wrbuf
+        blk.read_len = self.pending_bytes
+        blk.handlers = self.pending
+        blk.delay = delay
+        blk.clock_time = self.clock_time
+        self.program.append(blk)
+        self.wrbuf = array.array('B')
+        self.pending = []
+        self.pending_bytes = 0
+        self.clock_time = 0.0
+
+    def record(self):
+        """
+        start recording the mpsse command stream
+        scans, state changes and delays are compiled into blocks of commands
+        for playback with play(), nothing is sent to the ft2232
+        """
+        self.sync()
+        self.program = []
+
+    def record_stop(self):
+        """stop recording and return the recorded program"""
+        self.end_block()
+        program = self.program
+        self.program = None
+        return program
+
+    def play(self, program, progress = None):
+        """playback a recorded program"""
+        self.sync()
+        # with async writes the next block is queued before this one is read back,
+        # as long as the read data of both blocks fits in the rx fifo
+        pipeline = self.ftdi.writer is not None
+        rx_size = self.ftdi.fifo_sizes[1]
+        sent = 0
+        # clock time of the blocks since the last read
+        wait = 0.0
+        for (i, blk) in enumerate(program):
+            if sent == i:
+                self.ftdi.write_data(blk.data)
+                sent += 1
+            if pipeline and not blk.delay and sent < len(program) and \
+                blk.read_len + program[sent].read_len <= rx_size:
+                self.ftdi.write_data(program[sent].data)
+                sent += 1
+            wait += blk.clock_time
+            if blk.read_len:
+                rd = self.read(blk.read_len, wait)
+                wait = 0.0
+                if len(rd) != blk.read_len:
+                    raise IOError, 'ft2232 short read: %d of %d bytes' % (len(rd), blk.read_len)
+            else:
+                rd = None
+            _dispatch(blk.handlers, rd)
+            if blk.delay:
+                self.ftdi.writer_wait()
+                time.sleep(blk.delay)
+            if progress:
+                progress.update(i)
+
+    def set_frequency(self, f):
+        """set the tck frequency (at most f Hz), return the actual frequency"""
+        f = min(f, self.max_frequency)
+        hispeed = self.ftdi.type in Ftdi.HISPEED_DEVICES
+        cmds = []
+        if hispeed and f > Ftdi.BUS_CLOCK_BASE:
+            # 60 MHz clock
+            base = Ftdi.BUS_CLOCK_HIGH
+            cmds.append(Ftdi.DISABLE_CLK_DIV5)
+        else:
+            # 12 MHz clock
+            base = Ftdi.BUS_CLOCK_BASE
+            if hispeed:
+                cmds.append(Ftdi.ENABLE_CLK_DIV5)
+        # round the divisor up, the frequency must not exceed f
+        divisor = min(max(int(math.ceil(base / f)) - 1, 0), 0xffff)
+        cmds.extend((Ftdi.TCK_DIVISOR, _lsb(divisor), _msb(divisor)))
+        # in order with the queued commands
+        self.write(cmds)
+        self.done()
+        self.frequency = base / (divisor + 1)
+        return self.frequency
+
+    def serial(self):
+        """return the serial number of the adapter, or None"""
+        try:
+            return self.ftdi.serial
+        except (IOError, ValueError):
+            return None
+
+    def adapter(self):
+        """return a string naming the adapter (type and serial number)"""
+        serial = self.serial()
+        if serial:
+            return '%s %s' % (self.ftdi.type, serial)
+        return self.ftdi.type
+
+    def profile_name(self):
+        """return the tuning profile file name for the adapter"""
+        return os.path.join(_PROFILE_DIR, '%s.profile' % (self.serial() or self.ftdi.type))
+
+    def load_profiles(self):
+        """return the {workload: profile} tuning profiles for the adapter"""
+        return utils.load_marshal(self.profile_name(), _PROFILE_MAGIC) or {}
+
+    def load_profile(self, workload):
+        """return the tuning profile for a workload, or None"""
+        return self.load_profiles().get(workload)
+
+    def save_profile(self, workload, profile):
+        """save the tuning profile for a workload"""
+        profiles = self.load_profiles()
+        profiles[workload] = profile
+        utils.save_marshal(self.profile_name(), _PROFILE_MAGIC, profiles)
+
+    def set_profile(self, profile):
+        """use the chunk sizes and flush threshold of a tuning profile"""
+        self.sync()
+        self.ftdi.read_data_set_chunksize(profile['read_chunksize'])
+        self.ftdi.write_data_set_chunksize(profile['write_chunksize'])
+        self.tx_size = profile['tx_size']
+
+    def set_workload(self, workload):
+        """use the saved tuning profile for a workload (or the default settings)"""
+        if workload == self.workload:
+            return
+        self.set_profile(self.load_profile(workload) or self.default_profile)
+        self.workload = workload
+
+    def time_round_trips(self, n):
+        """return the time taken for n small command/response round trips"""
+        t = time.time()
+        for i in xrange(n):
+            self.write((Ftdi.GET_BITS_LOW, Ftdi.SEND_IMMEDIATE), True)
+            self.ftdi.read_data_bytes(1, _READ_RETRIES)
+        return time.time() - t
+
+    def time_stream(self, nbytes):
+        """return the time taken to shift and read back nbytes"""
+        # tms is held, so the TAP stays in its (stable) state
+        cmd = _MPSSE_DO_READ | _MPSSE_DO_WRITE | _MPSSE_LSB | _MPSSE_WRITE_NEG
+        chunk = self.ftdi.fifo_sizes[1] >> 1
+        zeros = bytearray(chunk)
+        t = time.time()
+        while nbytes:
+            k = min(nbytes, chunk)
+            self.make_room(k)
+            self.write((cmd, _lsb(k - 1), _msb(k - 1)))
+            self.write_buffer(zeros, k)
+            self.read_later(k, lambda rd: None)
+            nbytes -= k
+        self.sync()
+        return time.time() - t
+
+    def tune(self, workload = 'interactive'):
+        """
+        measure the adapter, then save and use a tuning profile for the workload
+        interactive: small register reads/writes, tuned for round trip time
+        bulk: long scans (configuration, svf), tuned for throughput
+        This resets the TAP and takes a few seconds, so it is only done on request.
+        """
+        if workload not in _WORKLOADS:
+            raise driver.Error, 'unknown workload %s' % workload
+        # tms = 1 in reset, the measurements don't change the TAP state
+        self.state_reset()
+        profile = {
+            'read_chunksize': 512,
+            'write_chunksize': self.ftdi.write_data_get_chunksize(),
+            'tx_size': self.ftdi.fifo_sizes[0],
+        }
+        # every read is forced out with SEND_IMMEDIATE, so the latency timer
+        # doesn't matter - just the read chunk size with the fastest round trips
+        # (the actual size - ftdi may limit it)
+        times = []
+        for rd_size in _TUNE_CHUNKSIZES:
+            profile['read_chunksize'] = rd_size
+            self.set_profile(profile)
+            times.append((self.time_round_trips(_TUNE_ROUNDS), self.ftdi.read_data_get_chunksize()))
+        profile['read_chunksize'] = min(times)[1]
+        if workload == 'bulk':
+            # the chunk sizes with the best throughput
+            times = []
+            for wr_size in _TUNE_CHUNKSIZES:
+                for rd_size in _TUNE_CHUNKSIZES:
+                    profile['write_chunksize'] = wr_size
+                    profile['read_chunksize'] = rd_size
+                    # send the commands once a write chunk has built up
+                    profile['tx_size'] = max(wr_size, self.ftdi.fifo_sizes[0])
+                    self.set_profile(profile)
+                    rd_size = self.ftdi.read_data_get_chunksize()
+                    times.append((self.time_stream(_TUNE_BYTES), wr_size, rd_size))
+            (t, wr_size, rd_size) = min(times)
+            profile['write_chunksize'] = wr_size
+            profile['read_chunksize'] = rd_size
+            profile['tx_size'] = max(wr_size, self.ftdi.fifo_sizes[0])
+        self.save_profile(workload, profile)
+        self.set_profile(profile)
+        self.workload = workload
+        return profile
+
+    def move(self, dst):
+        """queue the tms commands to change the TAP state from self.state to dst"""
+        cmds = _tms_table[self.state][dst]
+        if not cmds:
             # no state change
             assert self.state == dst
             return
-        tms = tms_mpsse(bits)
-        cmd = _MPSSE_WRITE_TMS | _MPSSE_BITMODE | _MPSSE_LSB | _MPSSE_WRITE_NEG
-        self.write((cmd, tms[0], tms[1]), True)
+        self.write(cmds)
         self.state = dst
 
+    def state_x(self, dst):
+        """change the TAP state from self.state to dst"""
+        self.move(dst)
+        self.done()
+
     def state_reset(self):
         """from *any* state go to the reset state"""
-        self.state = '*'
-        self.state_x('RESET')
+        self.write(_tms_reset)
+        self.state = tap.RESET
+        self.done()
+
+    def idle_clocks(self, n):
+        """clock tck n times without changing tms"""
+        if self.idle_clock:
+            # clock only commands
+            self.clocking(n)
+            nbytes = n >> 3
+            while nbytes:
+                k = min(nbytes, _MAX_BYTES)
+                self.write((_MPSSE_CLK_BYTES, _lsb(k - 1), _msb(k - 1)))
+                nbytes -= k
+            if n & 7:
+                self.write((_MPSSE_CLK_BITS, (n & 7) - 1))
+        else:
+            # shift out don't care tdi data
+            zeros = bytearray((min(n, _MAX_BYTES * 8) >> 3) + 1)
+            while n:
+                k = min(n, _MAX_BYTES * 8)
+                self.shift_bits(zeros, k)
+                n -= k
+
+    def clock(self, n, secs = 0.0):
+        """clock tck n times in the current (stable) state, taking at least secs seconds"""
+        # tms holds the level that got us into the state, so we stay there
+        self.idle_clocks(n)
+        if self.frequency:
+            # the clocks take part of the time
+            secs -= float(n) / self.frequency
+        if secs > 0:
+            self.delay(secs)
+        else:
+            self.done()
+
+    def set_tdi(self, bit):
+        """set the tdi level for the commands that don't shift data"""
+        # tms stays low, we are in a shift state
+        val = self.gpio_val | (0, _TDI)[bit]
+        self.write((Ftdi.SET_BITS_LOW, _lsb(val), _lsb(self.gpio_dir)))
+
+    def shift_const(self, bit, n, read_cmd = 0):
+        """shift n bits of constant tdi without sending the data"""
+        if n == 0:
+            return
+        if not read_cmd and not self.static_tdi:
+            # no clock only commands - send the data
+            wr = bytearray(('\x00', '\xff')[bit] * ((min(n, _MAX_BYTES * 8) >> 3) + 1))
+            while n:
+                k = min(n, _MAX_BYTES * 8)
+                self.shift_data_bits(wr, 0, k)
+                n -= k
+            return
+        self.set_tdi(bit)
+        if read_cmd:
+            # read only commands
+            self.clocking(n)
+            cmd = read_cmd | _MPSSE_LSB | _MPSSE_WRITE_NEG
+            nbytes = n >> 3
+            while nbytes:
+                k = min(nbytes, _MAX_BYTES)
+                self.write((cmd, _lsb(k - 1), _msb(k - 1)))
+                nbytes -= k
+            if n & 7:
+                self.write((cmd | _MPSSE_BITMODE, (n & 7) - 1))
+        else:
+            self.idle_clocks(n)
+
+    def shift_bits(self, wr, n, read_cmd = 0):
+        """shift out the first n bits of the byte array wr"""
+        nbytes = n >> 3
+        nbits = n & 7
+        # write out the full bytes
+        self.shift_bytes(wr, 0, nbytes, read_cmd)
+        # write out the remaining bits
+        if nbits:
+            self.clocking(nbits)
+            cmd = read_cmd | _MPSSE_DO_WRITE | _MPSSE_LSB | _MPSSE_BITMODE | _MPSSE_WRITE_NEG
+            self.write((cmd, nbits - 1, wr[nbytes]))
+
+    def shift_bytes(self, wr, ofs, nbytes, read_cmd = 0):
+        """shift out nbytes of the byte array wr from ofs, constant runs are sent without the data"""
+        if nbytes >= _STATIC_MIN and (read_cmd or self.static_tdi):
+            end = ofs + nbytes
+            for m in _static_runs.finditer(wr, ofs, end):
+                (i, j) = m.span()
+                self.shift_data_bytes(wr, ofs, i - ofs, read_cmd)
+                self.shift_const(wr[i] & 1, (j - i) << 3, read_cmd)
+                ofs = j
+            nbytes = end - ofs
+        self.shift_data_bytes(wr, ofs, nbytes, read_cmd)
+
+    def shift_data_bits(self, wr, ofs, n):
+        """shift out n bits of the byte array wr from byte ofs, all as data"""
+        self.shift_data_bytes(wr, ofs, n >> 3)
+        if n & 7:
+            self.clocking(n & 7)
+            cmd = _MPSSE_DO_WRITE | _MPSSE_LSB | _MPSSE_BITMODE | _MPSSE_WRITE_NEG
+            self.write((cmd, (n & 7) - 1, wr[ofs + (n >> 3)]))
+
+    def shift_data_bytes(self, wr, ofs, nbytes, read_cmd = 0):
+        """shift out nbytes of the byte array wr from ofs, all as data"""
+        cmd = read_cmd | _MPSSE_DO_WRITE | _MPSSE_LSB | _MPSSE_WRITE_NEG
+        self.clocking(nbytes << 3)
+        while nbytes:
+            # the length field is 16 bits
+            k = min(nbytes, _MAX_BYTES)
+            self.write((cmd, _lsb(k - 1), _msb(k - 1)))
+            self.write_buffer(wr, k, ofs)
+            ofs += k
+            nbytes -= k
+
+    def shift_last(self, bit, end_state, read_cmd = 0):
+        """shift the last bit out on tdi while moving to end_state, return the tms (len, bits) tuple"""
+        # the last bit of output data is bit 7 of the tms value (goes onto tdi)
+        tms = _tms_last_table[self.state][end_state]
+        self.write((read_cmd | _TMS_CMD, tms[0], tms[1] | (bit << 7)))
+        self.state = end_state
+        return tms
+
+    def shift_segments(self, tdi, end_state):
+        """write a segmented bit stream (bits.rope) without joining the segments"""
+        segs = [s for s in tdi.segments()]
+        for (i, (n, bit, buf)) in enumerate(segs):
+            if i == len(segs) - 1:
+                # hold back the last bit for the tms command
+                n -= 1
+            if bit is not None and n >= _STATIC_MIN << 3:
+                # long fills are never sent as data
+                self.shift_const(bit, n)
+                continue
+            if bit is None:
+                wr = buf.get()
+            else:
+                wr = bytearray(('\x00', '\xff')[bit] * ((n >> 3) + 1))
+            self.shift_bits(wr, n)
+        # the last bit of the stream is the msb of the last segment
+        if bit is None:
+            bit = (wr[n >> 3] >> (n & 7)) & 1
+        self.shift_last(bit, end_state)
 
     def shift_data(self, tdi, tdo, end_state):
         """
@@ -135,79 +715,71 @@ class jtag_driver:
         tdo - bit buffer for the data read from the JTAG TDO pin (optional)
         end_state - leave the TAP state machine in this state
         """
+        if tdo is None and hasattr(tdi, 'segments'):
+            # write only - stream the segments
+            self.shift_segments(tdi, end_state)
+            self.done()
+            return
+
         wr = tdi.get()
         io_bits = tdi.n - 1
         io_bytes = io_bits >> 3
         io_bits &= 0x07
-        last_bit = (wr[io_bytes] << (7 - io_bits)) & 128
-
-        if tdo is not None:
-            read_cmd = _MPSSE_DO_READ
-            read_len = io_bytes + 1
-            if io_bits:
-                read_len += 1
-        else:
-            read_cmd = 0
-            read_len = 0
-
-        # write out the full bytes
-        if io_bytes:
-            cmd = read_cmd | _MPSSE_DO_WRITE | _MPSSE_LSB | _MPSSE_WRITE_NEG
-            num = io_bytes - 1
-            self.write((cmd, _lsb(num), _msb(num)))
-            self.write(wr[0:io_bytes])
-
-        # write out the remaining bits
-        if io_bits:
-            cmd = read_cmd | _MPSSE_DO_WRITE | _MPSSE_LSB | _MPSSE_BITMODE | _MPSSE_WRITE_NEG
-            self.write((cmd, io_bits - 1, wr[io_bytes]))
-
-        # the last bit of output data is bit 7 of the tms value (goes onto tdi)
-        # continue to read to get the last bit of tdo data
-        cmd = read_cmd | _MPSSE_WRITE_TMS | _MPSSE_BITMODE | _MPSSE_LSB | _MPSSE_WRITE_NEG
-        tms = tms_mpsse(self.tap.tms(self.state, end_state))
-        self.write((cmd, tms[0], tms[1] | last_bit))
-        self.state = end_state
+        last_bit = (wr[io_bytes] >> io_bits) & 1
 
-        # if we are only writing, return
         if tdo is None:
-            self.flush()
+            # write out all but the last bit
+            self.shift_bits(wr, tdi.n - 1)
+            self.shift_last(last_bit, end_state)
+            self.done()
             return
 
-        # make the ft2232 flush its data back to the PC
-        self.write((Ftdi.SEND_IMMEDIATE,), True)
-        rd = self.ftdi.read_data_bytes(read_len, _READ_RETRIES)
-
-        if io_bits:
-            # the n partial bits are in the top n bits of the byte
-            # move them down to the bottom
-            rd[-2] >>= (8 - io_bits)
-
-        # get the last bit from the tms response byte (last byte)
-        last_bit = (rd[-1] >> (7 - tms[0])) & 1
-        last_bit <<= io_bits
-
-        # add the last bit
+        read_cmd = _MPSSE_DO_READ
+        # the full bytes, the partial bits and the tms response
+        read_len = io_bytes + 1
         if io_bits:
-            # drop the tms response byte
-            del rd[-1]
-            # or it onto the io_bits byte
-            rd[-1] |= last_bit
+            read_len += 1
+        # keep the queued reads within the rx fifo
+        chunk = self.ftdi.fifo_sizes[1] >> 1
+        if read_len <= chunk:
+            self.make_room(read_len)
+            self.shift_bits(wr, tdi.n - 1, read_cmd)
+            tms = self.shift_last(last_bit, end_state, read_cmd)
+            self.read_later(read_len, _tdo_decoder(tdo, tdi.n, io_bits, tms[0]))
         else:
-            # replace the tms response byte
-            rd[-1] = last_bit
-
-        # copy to the bit buffer
-        tdo.set(tdi.n, rd)
+            # a big scan - shift the full bytes in half rx fifo pieces
+            # so one piece is read while the next is being shifted
+            rd = bytearray()
+            ofs = 0
+            while ofs < io_bytes:
+                k = min(io_bytes - ofs, chunk)
+                self.make_room(k)
+                self.shift_bytes(wr, ofs, k, read_cmd)
+                self.read_later(k, rd.extend)
+                ofs += k
+            # then the partial bits and the last bit
+            self.make_room(read_len - io_bytes)
+            if io_bits:
+                cmd = read_cmd | _MPSSE_DO_WRITE | _MPSSE_LSB | _MPSSE_BITMODE | _MPSSE_WRITE_NEG
+                self.write((cmd, io_bits - 1, wr[io_bytes]))
+            tms = self.shift_last(last_bit, end_state, read_cmd)
+            decode = _tdo_decoder(tdo, tdi.n, io_bits, tms[0])
+            def tail(x):
+                # decode in place, no copy of the whole scan
+                rd.extend(x)
+                decode(rd)
+            self.read_later(read_len - io_bytes, tail)
+        if not self.deferred:
+            self.sync()
 
     def scan_ir(self, tdi, tdo = None):
         """write (and possibly read) a bit stream through the IR in the JTAG chain"""
-        self.state_x('IRSHIFT')
+        self.move(tap.IRSHIFT)
         self.shift_data(tdi, tdo, self.sir_end_state)
 
     def scan_dr(self, tdi, tdo = None):
         """write (and possibly read) a bit stream through the DR in the JTAG chain"""
-        self.state_x('DRSHIFT')
+        self.move(tap.DRSHIFT)
         self.shift_data(tdi, tdo, self.sdr_end_state)
 
     def test_reset(self, val):
@@ -230,10 +802,11 @@ class jtag_driver:
         self.ftdi.write_data((Ftdi.SET_BITS_HIGH, _msb(self.gpio_val), _msb(self.gpio_dir)))
 
     def gpio_out(self, gpio):
+        # in order with the queued commands
         if gpio <= _GPIOL3:
-            self.ftdi.write_data((Ftdi.SET_BITS_LOW, _lsb(self.gpio_val), _lsb(self.gpio_dir)))
+            self.write((Ftdi.SET_BITS_LOW, _lsb(self.gpio_val), _lsb(self.gpio_dir)), True)
         else:
-            self.ftdi.write_data((Ftdi.SET_BITS_HIGH, _msb(self.gpio_val), _msb(self.gpio_dir)))
+            self.write((Ftdi.SET_BITS_HIGH, _msb(self.gpio_val), _msb(self.gpio_dir)), True)
 
     def gpio_set(self, gpio):
         """set a gpio pin"""
@@ -249,6 +822,7 @@ class jtag_driver:
 
     def gpio_rd(self, gpio):
         """read a gpio pin"""
+        self.sync()
         if gpio <= _GPIOL3:
             self.ftdi.write_data((Ftdi.GET_BITS_LOW,))
             val = self.ftdi.read_data_bytes(1, _READ_RETRIES)[0]
@@ -27,18 +27,95 @@ Require: pyusb
 
 import os
 import struct
+import threading
+import Queue
 import usb.core
 import usb.util
 from array import array as Array
 from usbtools import UsbTools
 
-__all__ = ['Ftdi', 'FtdiError']
+__all__ = ['Ftdi', 'FtdiError', 'FtdiTransfer']
 
 
 class FtdiError(IOError):
     """Communication error with the FTDI device"""
 
 
+class FtdiTransfer(object):
+    """A queued write to the chip, done once the data has been sent"""
+
+    def __init__(self, data, callback=None, chunksize=None):
+        self.data = data
+        self.chunksize = chunksize
+        self.callback = callback
+        self.error = None
+        self._event = threading.Event()
+
+    def done(self):
+        """Tell whether the data has been sent (or the write has failed)"""
+        return self._event.is_set()
+
+    def wait(self):
+        """Wait for the data to be sent, raise the error of a failed write"""
+        self._event.wait()
+        if self.error:
+            raise self.error
+
+    def _complete(self, error):
+        self.error = error
+        self.data = None
+        self._event.set()
+        if self.callback:
+            self.callback(self)
+
+
+class _FtdiWriter(object):
+    """Background thread writing queued transfers to the chip, so the
+       caller prepares the next data while the previous data is sent."""
+
+    def __init__(self, ftdi, depth):
+        self.ftdi = ftdi
+        # put() blocks once depth transfers are waiting to be sent
+        self.queue = Queue.Queue(depth)
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, transfer):
+        """Queue a transfer"""
+        if self.error:
+            raise self.error
+        self.queue.put(transfer)
+
+    def wait(self):
+        """Wait for all the queued transfers, raise the first error"""
+        self.queue.join()
+        if self.error:
+            error, self.error = self.error, None
+            raise error
+
+    def stop(self):
+        """Send the queued transfers and end the thread"""
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            transfer = self.queue.get()
+            if transfer is None:
+                self.queue.task_done()
+                return
+            error = self.error
+            if not error:
+                try:
+                    self.ftdi._write_data(transfer.data, transfer.chunksize)
+                except IOError, e:
+                    error = self.error = e
+            transfer._complete(error)
+            self.queue.task_done()
+
+
 class Ftdi(object):
     """FTDI device driver"""
 
@@ -203,6 +280,9 @@ class Ftdi(object):
     BAUDRATE_TOLERANCE = 3.0 # acceptable clock drift, in %
     BITBANG_CLOCK_MULTIPLIER = 4
 
+    # Bulk write transfers are this many tx fifos (rounded to packets)
+    WRITE_FIFO_MULTIPLIER = 16
+
     # Latency
     LATENCY_MIN = 1
     LATENCY_MAX = 255
@@ -218,7 +298,7 @@ class Ftdi(object):
         self.usb_read_timeout = 5000
         self.usb_write_timeout = 5000
         self.baudrate = -1
-        self.readbuffer = Array('B')
+        self.readbuffer = bytearray()
         self.readoffset = 0
         self.readbuffer_chunksize = 4 << 10 # 4KiB
         self.writebuffer_chunksize = 4 << 10 # 4KiB
@@ -233,6 +313,7 @@ class Ftdi(object):
         self.latency_min = self.LATENCY_MIN
         self.latency_max = self.LATENCY_MAX
         self.latency_threshold = None # disable dynamic latency
+        self.writer = None # background writer (async writes)
 
     # --- Public API -------------------------------------------------------
 
@@ -258,6 +339,7 @@ class Ftdi(object):
 
     def close(self):
         """Close the FTDI interface"""
+        self.set_async_writes(0)
         self.set_latency_timer(self.LATENCY_MAX)
         UsbTools.release_device(self.usb_dev)
 
@@ -270,7 +352,7 @@ class Ftdi(object):
         # Set latency timer
         self.set_latency_timer(latency)
         # Set chunk size
-        self.write_data_set_chunksize(512)
+        self.write_data_set_chunksize(self.write_data_auto_chunksize())
         self.read_data_set_chunksize(512)
         # Drain input buffer
         self.purge_buffers()
@@ -335,6 +417,12 @@ class Ftdi(object):
             return Ftdi.BUS_CLOCK_HIGH
         return Ftdi.BUS_CLOCK_BASE
 
+    @property
+    def serial(self):
+        """Return the serial number string of the device"""
+        return usb.util.get_string(self.usb_dev, 64,
+                                   self.usb_dev.iSerialNumber)
+
     @property
     def fifo_sizes(self):
         """Return the (TX, RX) tupple of hardware FIFO sizes"""
@@ -358,6 +446,7 @@ class Ftdi(object):
         if delta > Ftdi.BAUDRATE_TOLERANCE:
             raise AssertionError('Baudrate tolerance exceeded: %.02f%% '
                 '(wanted %d, achievable %d)' % (delta, baudrate, actual) )
+        self.writer_wait()
         try:
             if self.usb_dev.ctrl_transfer(Ftdi.REQ_OUT,
                                           Ftdi.SIO_SET_BAUDRATE, value,
@@ -376,7 +465,7 @@ class Ftdi(object):
             raise FtdiError('Unable to flush RX buffer')
         # Invalidate data in the readbuffer
         self.readoffset = 0
-        self.readbuffer = Array('B')
+        self.readbuffer = bytearray()
 
     def purge_tx_buffer(self):
         """Clear the write buffer on the chip."""
@@ -397,16 +486,22 @@ class Ftdi(object):
         """Get write buffer chunk size."""
         return self.writebuffer_chunksize
 
+    def write_data_auto_chunksize(self):
+        """Return a write chunk size for bulk transfers: a number of
+           tx fifos, rounded up to whole usb packets."""
+        packet_size = self.max_packet_size or 64
+        size = self.fifo_sizes[0] * self.WRITE_FIFO_MULTIPLIER
+        return ((size+packet_size-1) // packet_size) * packet_size
+
     def read_data_set_chunksize(self, chunksize):
         """Configure read buffer chunk size."""
         # Invalidate all remaining data
         self.readoffset = 0
-        self.readbuffer = Array('B')
+        self.readbuffer = bytearray()
         import sys
-        if sys.platform == 'linux':
+        if sys.platform.startswith('linux'):
             if chunksize > 16384:
                 chunksize = 16384
-        self.readbuffer = []
         self.readbuffer_chunksize = chunksize
 
     def read_data_get_chunksize(self):
@@ -474,6 +569,7 @@ class Ftdi(object):
                  'sw' : Ftdi.SIO_XON_XOFF_HS,
                  '' : Ftdi.SIO_DISABLE_FLOW_CTRL }
         value = ctrl[flowctrl] | self.index
+        self.writer_wait()
         try:
             if self.usb_dev.ctrl_transfer(Ftdi.REQ_OUT,
                                           Ftdi.SIO_SET_FLOW_CTRL, 0,
@@ -553,17 +649,72 @@ class Ftdi(object):
         if self._ctrl_transfer_out(Ftdi.SIO_SET_DATA, value):
             raise FtdiError('Unable to set line property')
 
-    def write_data(self, data):
+    def set_async_writes(self, depth):
+        """Write data from a background thread, with up to depth writes
+           queued behind the one being sent. A depth of 0 goes back to
+           synchronous writes."""
+        if self.writer:
+            writer, self.writer = self.writer, None
+            writer.stop()
+            if writer.error:
+                raise writer.error
+        if depth > 0:
+            self.writer = _FtdiWriter(self, depth)
+
+    def writer_wait(self):
+        """Wait for the queued writes to be sent"""
+        if self.writer:
+            self.writer.wait()
+
+    def write_data_async(self, data, callback=None, chunksize=None):
+        """Queue data to write to the chip, return a FtdiTransfer for it.
+           The data is copied, the caller may reuse its buffer. Completion
+           callbacks are run on the writer thread."""
+        if not self.writer:
+            raise AssertionError("Async writes are not enabled")
+        buf = Array('B')
+        buf.fromstring(buffer(self._as_buffer(data)))
+        transfer = FtdiTransfer(buf, callback, chunksize)
+        self.writer.submit(transfer)
+        return transfer
+
+    def write_data(self, data, chunksize=None):
+        """Write data in chunks to the chip. The data is any buffer
+           object (or a sequence of byte values), the chunk size (the
+           largest usb transfer) defaults to write_data_get_chunksize()"""
+        if self.writer:
+            # queued, in order with the writes before it
+            self.write_data_async(data, None, chunksize)
+            return len(data)
+        return self._write_data(data, chunksize)
+
+    @staticmethod
+    def _as_buffer(data):
+        """Return data as an object supporting buffer()"""
+        if isinstance(data, (Array, str, bytearray, buffer)):
+            return data
+        if isinstance(data, memoryview):
+            return data.tobytes()
+        return Array('B', data)
+
+    def _write_data(self, data, chunksize=None):
         """Write data in chunks to the chip"""
+        if not chunksize:
+            chunksize = self.writebuffer_chunksize
+        data = self._as_buffer(data)
         offset = 0
         size = len(data)
         try:
             while offset < size:
-                write_size = self.writebuffer_chunksize
-                if offset + write_size > size:
-                    write_size = size - offset
+                write_size = min(chunksize, size-offset)
+                if write_size == size and isinstance(data, (Array, str)):
+                    # pyusb takes these as they are
+                    chunk = data
+                else:
+                    # no slice copy, pyusb makes its array from the buffer
+                    chunk = buffer(data, offset, write_size)
                 length = self.usb_dev.write(self.in_ep,
-                                            data[offset:offset+write_size],
+                                            chunk,
                                             self.interface,
                                             self.usb_write_timeout)
                 if length <= 0:
@@ -573,102 +724,92 @@ class Ftdi(object):
         except usb.core.USBError, e:
             raise FtdiError('UsbError: %s' % str(e))
 
-    def read_data_bytes(self, size, attempt=1):
-        """Read data in chunks from the chip.
+    def read_data_into(self, buf, size=None, attempt=1):
+        """Read data from the chip into a caller supplied buffer (a
+           bytearray or a memoryview of one), without intermediate arrays.
            Automatically strips the two modem status bytes transfered during
-           every read."""
+           every read. Return the number of bytes read, which is less than
+           size if the chip has no more data."""
         # Packet size sanity check
         if not self.max_packet_size:
             raise FtdiError("max_packet_size is bogus")
         packet_size = self.max_packet_size
-        length = 1 # initial condition to enter the usb_read loop
-        data = Array('B')
-        # everything we want is still in the cache?
-        if size <= len(self.readbuffer)-self.readoffset:
-            data = self.readbuffer[self.readoffset:self.readoffset+size]
-            self.readoffset += size
-            return data
-        # something still in the cache, but not enough to satisfy 'size'?
-        if len(self.readbuffer)-self.readoffset != 0:
-            data = self.readbuffer[self.readoffset:]
-            # end of readbuffer reached
-            self.readoffset = len(self.readbuffer)
-        # read from USB, filling in the local cache as it is empty
+        view = memoryview(buf)
+        if size is None:
+            size = len(view)
+        pos = 0
         try:
-            while (len(data) < size) and (length > 0):
-                while True:
-                    tempbuf = self.usb_dev.read(self.out_ep,
-                                                self.readbuffer_chunksize,
-                                                self.interface,
-                                                self.usb_read_timeout)
-                    attempt -= 1
-                    length = len(tempbuf)
-                    # the received buffer contains at least one useful databyte
-                    # (first 2 bytes in each packet represent the current modem
-                    # status)
-                    if length > 2:
-                        if self.latency_threshold:
-                            self.latency_count = 0
-                            if self.latency != self.latency_min:
-                                self.set_latency_timer(self.latency_min)
-                                self.latency = self.latency_min
-                        # skip the status bytes
-                        chunks = (length+packet_size-1) // packet_size
-                        count = packet_size - 2
-                        self.readbuffer = Array('B')
-                        self.readoffset = 0
-                        srcoff = 2
-                        for i in xrange(chunks):
-                            self.readbuffer += tempbuf[srcoff:srcoff+count]
-                            srcoff += packet_size
-                        length = len(self.readbuffer)
-                        break
-                    else:
-                        # received buffer only contains the modem status bytes
-                        # no data received, may be late, try again
-                        if attempt > 0:
-                            continue
-                        # no actual data
-                        self.readbuffer = Array('B')
-                        self.readoffset = 0
-                        if self.latency_threshold:
-                            self.latency_count += 1
-                            if self.latency != self.latency_max:
-                                if self.latency_count > self.latency_threshold:
-                                    self.set_latency_timer(self.latency_max)
-                                    self.latency = self.latency_max
-                        # no more data to read?
-                        return data
-                if length > 0:
-                    # data still fits in buf?
-                    if (len(data) + length) <= size:
-                        data += self.readbuffer[self.readoffset: \
-                                                self.readoffset+length]
-                        self.readoffset += length
-                        # did we read exactly the right amount of bytes?
-                        if len(data) == size:
-                            return data
-                    else:
-                        # partial copy, not enough bytes in the local cache to
-                        # fulfill the request
-                        part_size = min(size-len(data),
-                                        len(self.readbuffer)-self.readoffset)
-                        if part_size < 0:
-                            raise AssertionError("Internal Error")
-                        data += self.readbuffer[self.readoffset:\
-                                                self.readoffset+part_size]
-                        self.readoffset += part_size
-                        return data
+            while pos < size:
+                # first use what is still in the cache
+                avail = len(self.readbuffer)-self.readoffset
+                if avail:
+                    count = min(avail, size-pos)
+                    view[pos:pos+count] = buffer(self.readbuffer,
+                                                 self.readoffset, count)
+                    self.readoffset += count
+                    pos += count
+                    continue
+                # read from USB, filling in the local cache as it is empty
+                tempbuf = self.usb_dev.read(self.out_ep,
+                                            self.readbuffer_chunksize,
+                                            self.interface,
+                                            self.usb_read_timeout)
+                attempt -= 1
+                # the received buffer contains at least one useful databyte
+                # (first 2 bytes in each packet represent the current modem
+                # status)
+                if len(tempbuf) > 2:
+                    if self.latency_threshold:
+                        self.latency_count = 0
+                        if self.latency != self.latency_min:
+                            self.set_latency_timer(self.latency_min)
+                            self.latency = self.latency_min
+                    # reuse the cache storage
+                    self.readbuffer[:] = buffer(tempbuf)
+                    self.readoffset = 0
+                    # skip the status bytes: drop the first byte of every
+                    # packet, then the (new) first byte of every packet
+                    del self.readbuffer[0::packet_size]
+                    del self.readbuffer[0::packet_size-1]
+                    continue
+                # received buffer only contains the modem status bytes
+                # no data received, may be late, try again
+                if attempt > 0:
+                    continue
+                # no actual data
+                if self.latency_threshold:
+                    self.latency_count += 1
+                    if self.latency != self.latency_max:
+                        if self.latency_count > self.latency_threshold:
+                            self.set_latency_timer(self.latency_max)
+                            self.latency = self.latency_max
+                # no more data to read
+                break
         except usb.core.USBError, e:
             raise FtdiError('UsbError: %s' % str(e))
-        # never reached
-        raise FtdiError("Internal error")
+        return pos
+
+    def read_data_bytes(self, size, attempt=1):
+        """Read data in chunks from the chip, return a bytearray.
+           Automatically strips the two modem status bytes transfered during
+           every read."""
+        avail = len(self.readbuffer)-self.readoffset
+        if size <= avail:
+            # everything we want is still in the cache
+            data = self.readbuffer[self.readoffset:self.readoffset+size]
+            self.readoffset += size
+            return data
+        data = bytearray(size)
+        length = self.read_data_into(data, size, attempt)
+        if length < size:
+            del data[length:]
+        return data
 
     def read_data(self, size):
         """Read data in chunks from the chip.
            Automatically strips the two modem status bytes transfered during
            every read."""
-        return self.read_data_bytes(size).tostring()
+        return str(self.read_data_bytes(size))
 
     def get_cts(self):
         """Read terminal status line: Clear To Send"""
@@ -734,10 +875,12 @@ class Ftdi(object):
             raise FtdiError('Unable to reset FTDI device')
         # Invalidate data in the readbuffer
         self.readoffset = 0
-        self.readbuffer = Array('B')
+        self.readbuffer = bytearray()
 
     def _ctrl_transfer_out(self, reqtype, value, data=''):
         """Send a control message to the device"""
+        # after any queued writes
+        self.writer_wait()
         try:
             return self.usb_dev.ctrl_transfer(Ftdi.REQ_OUT, reqtype, value,
                                               self.index, data,
@@ -747,6 +890,7 @@ class Ftdi(object):
 
     def _ctrl_transfer_in(self, reqtype, length):
         """Request for a control message from the device"""
+        self.writer_wait()
         try:
             return self.usb_dev.ctrl_transfer(Ftdi.REQ_IN, reqtype, 0,
                                               self.index, length,
@@ -5,6 +5,8 @@ JTAG Chain Controller
 """
 #-----------------------------------------------------------------------------
 
+import os
+import utils
 import bits
 
 #-----------------------------------------------------------------------------
@@ -18,6 +20,13 @@ _max_devices = 4
 _flush_size = _max_devices * 32
 _idcode_length = 32
 
+# tck calibration
+_TCK_FILE = os.path.join(os.path.expanduser('~'), '.pyxs', 'tck')
+_TCK_MAGIC = 'TCKF'
+_CAL_DIVIDERS = (1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30, 60)
+_CAL_ROUNDS = 16
+_CAL_BITS = 4096
+
 #-----------------------------------------------------------------------------
 # Device ID Codes and Lookup Table
 
@@ -42,23 +51,51 @@ def lookup_device(x):
 
 #-----------------------------------------------------------------------------
 
+class future:
+    """the result of a queued scan, available after jtag.flush()"""
+
+    def __init__(self):
+        self.val = None
+
+    def set(self, val):
+        self.val = val
+
+    def done(self):
+        """return True if the result is available"""
+        return self.val is not None
+
+    def result(self):
+        """return the result (the bit buffer read by the scan)"""
+        if self.val is None:
+            raise Error, 'queued scan has not been flushed'
+        return self.val
+
+#-----------------------------------------------------------------------------
+
 class jtag:
 
     def __init__(self, driver):
         self.driver = driver
+        # the driver limit before any calibration
+        self.max_frequency = driver.max_frequency
 
     def scan(self, idcode_x):
         """try to find the device with idcode on the jtag chain"""
         self.driver.reset_jtag()
-        self.ndevs = self.num_devices()
-        self.irlen_total = self.ir_length()
+        # queue the chain length scans, read them back together
+        ndevs = self.queue_num_devices()
+        irlen_total = self.queue_chain_length(self.driver.scan_ir)
+        self.flush()
+        self.ndevs = ndevs.result()
+        self.irlen_total = irlen_total.result()
         self.idcode = 0
         self.ndevs_before = 0
         self.ndevs_after = 0
         self.irlen_before = 0
         self.irlen_after = 0
         found = False
-        for idcode in self.reset_idcodes():
+        self.idcodes = self.reset_idcodes()
+        for idcode in self.idcodes:
             (name, irlen, mask) = lookup_device(idcode)
             if name == 'unknown':
                 raise Error, 'unknown device on jtag chain - idcode 0x%08x' % idcode
@@ -78,25 +115,47 @@ class jtag:
             raise Error, 'unable to find device on jtag chain - idcode 0x%08x' % self.idcode
         if (self.irlen_before + self.irlen + self.irlen_after) != self.irlen_total:
             raise Error, 'incorrect ir lengths - %d + (%d) + %d != %d' % (self.irlen_before, self.irlen, self.irlen_after, self.irlen_total)
+        # use the calibrated tck frequency for the chain
+        f = self.load_frequencies().get(self.chain_name())
+        if f is not None:
+            self.driver.max_frequency = self.driver.set_frequency(f)
 
-    def num_devices(self):
-        """return the number of JTAG devices in the chain"""
+    def queue_num_devices(self):
+        """queue scans for the number of JTAG devices in the chain, return a future for it"""
         # put every device into bypass mode (IR = all 1's)
         tdi = bits.bits()
         tdi.ones(_flush_size)
-        self.driver.scan_ir(tdi)
+        self.batch(self.driver.scan_ir, tdi)
         # now each DR is a single bit
         # the DR chain length is the number of devices
-        return self.dr_length()
+        return self.queue_chain_length(self.driver.scan_dr)
 
-    def chain_length(self, scan):
-        """return the length of the JTAG chain"""
+    def num_devices(self):
+        """return the number of JTAG devices in the chain"""
+        n = self.queue_num_devices()
+        self.flush()
+        return n.result()
+
+    def queue_chain_length(self, scan):
+        """queue a scan for the length of the JTAG chain, return a future for it"""
+        f = future()
         tdo = bits.bits()
         # build a 000...001000...000 flush buffer for tdi
         tdi = bits.bits(_flush_size)
         tdi.append_ones(1)
         tdi.append_zeroes(_flush_size)
-        scan(tdi, tdo)
+        self.batch(scan, tdi, tdo)
+        self.later(lambda: f.set(self.flushed_length(tdo)))
+        return f
+
+    def chain_length(self, scan):
+        """return the length of the JTAG chain"""
+        n = self.queue_chain_length(scan)
+        self.flush()
+        return n.result()
+
+    def flushed_length(self, tdo):
+        """return the chain length from the tdo of a flush buffer scan"""
         # the first bits are junk
         tdo.drop_lsb(_flush_size)
         # work out how many bits tdo is behind tdi
@@ -126,13 +185,83 @@ class jtag:
         self.driver.scan_dr(tdi, tdo)
         return tdo.scan((_idcode_length, ) * self.ndevs)
 
+    def loopback(self, n):
+        """shift n random bits through the bypassed chain, return True if they come back intact"""
+        # put every device into bypass mode (IR = all 1's)
+        tdi = bits.bits()
+        tdi.ones(self.irlen_total)
+        self.driver.scan_ir(tdi)
+        # each DR is a single bit, the data comes out ndevs bits later
+        wr = bits.bytebits()
+        wr.random(n)
+        tdi = bits.rope()
+        tdi.append_zeroes(self.ndevs)
+        tdi.append(wr)
+        tdo = bits.bytebits()
+        self.driver.scan_dr(tdi, tdo)
+        self.sync()
+        tdo.drop_lsb(self.ndevs)
+        return tdo == wr
+
+    def reliable(self, rounds = _CAL_ROUNDS, n = _CAL_BITS):
+        """return True if the chain passes repeated idcode and loopback scans"""
+        for i in xrange(rounds):
+            if self.reset_idcodes() != self.idcodes:
+                return False
+            if not self.loopback(n):
+                return False
+        return True
+
+    def calibrate(self, rounds = _CAL_ROUNDS):
+        """find the highest reliable tck frequency, back off a step for margin, record and use it"""
+        fmax = self.max_frequency
+        if fmax is None:
+            raise Error, '%s: tck frequency control is not supported' % self.driver
+        self.driver.max_frequency = fmax
+        # candidate frequencies (as set), fastest first
+        freqs = []
+        for k in _CAL_DIVIDERS:
+            f = self.driver.set_frequency(float(fmax) / k)
+            if f not in freqs:
+                freqs.append(f)
+        good = None
+        for (i, f) in enumerate(freqs):
+            self.driver.set_frequency(f)
+            if self.reliable(rounds):
+                # the next slower frequency is the margin
+                good = freqs[min(i + 1, len(freqs) - 1)]
+                break
+        if good is None:
+            self.driver.set_frequency(freqs[-1])
+            raise Error, 'no reliable tck frequency for the jtag chain'
+        self.driver.set_frequency(good)
+        if not self.reliable(rounds):
+            raise Error, 'tck frequency %d Hz is not reliable' % good
+        self.driver.max_frequency = good
+        self.save_frequency(good)
+        return good
+
+    def chain_name(self):
+        """return the key for the chain (adapter and devices) in the tck calibration file"""
+        return '%s %s' % (self.driver.adapter(), ' '.join(['%08x' % x for x in self.idcodes]))
+
+    def load_frequencies(self):
+        """return the {chain: frequency} calibrated tck frequencies"""
+        return utils.load_marshal(_TCK_FILE, _TCK_MAGIC) or {}
+
+    def save_frequency(self, freq):
+        """record the calibrated tck frequency for the chain"""
+        freqs = self.load_frequencies()
+        freqs[self.chain_name()] = freq
+        utils.save_marshal(_TCK_FILE, _TCK_MAGIC, freqs)
+
     def wr_ir(self, wr):
         """
         write to IR for a device
         wr: the bitbuffer to be written to ir for this device
         note - other devices will be placed in bypass mode (ir = all 1's)
         """
-        tdi = bits.bits()
+        tdi = bits.rope()
         tdi.append_ones(self.irlen_before)
         tdi.append(wr)
         tdi.append_ones(self.irlen_after)
@@ -145,14 +274,16 @@ class jtag:
         rd: bitbuffer to be read from ir for this device
         note - other devices are assumed to be in bypass mode
         """
-        tdi = bits.bits()
+        tdi = bits.rope()
         tdi.append_ones(self.irlen_before)
         tdi.append(wr)
         tdi.append_ones(self.irlen_after)
         self.driver.scan_ir(tdi, rd)
-        # strip the ir bits from the bypassed devices
-        rd.drop_msb(self.irlen_before)
-        rd.drop_lsb(self.irlen_after)
+        def strip():
+            # strip the ir bits from the bypassed devices
+            rd.drop_msb(self.irlen_before)
+            rd.drop_lsb(self.irlen_after)
+        self.later(strip)
 
     def wr_dr(self, wr):
         """
@@ -160,7 +291,7 @@ class jtag:
         wr: bitbuffer to be written to dr for this device
         note - other devices are assumed to be in bypass mode
         """
-        tdi = bits.bits()
+        tdi = bits.rope()
         tdi.append_ones(self.ndevs_before)
         tdi.append(wr)
         tdi.append_ones(self.ndevs_after)
@@ -173,14 +304,65 @@ class jtag:
         rd: bitbuffer to be read from dr for this device
         note - other devices are assumed to be in bypass mode
         """
-        tdi = bits.bits()
+        tdi = bits.rope()
         tdi.append_ones(self.ndevs_before)
         tdi.append(wr)
         tdi.append_ones(self.ndevs_after)
         self.driver.scan_dr(tdi, rd)
-        # strip the dr bits from the bypassed devices
-        rd.drop_msb(self.ndevs_before)
-        rd.drop_lsb(self.ndevs_after)
+        def strip():
+            # strip the dr bits from the bypassed devices
+            rd.drop_msb(self.ndevs_before)
+            rd.drop_lsb(self.ndevs_after)
+        self.later(strip)
+
+    def batch(self, op, *args):
+        """call op(*args) with the driver batching the commands until flush()"""
+        deferred = self.driver.deferred
+        self.driver.deferred = self.driver.queued
+        try:
+            return op(*args)
+        finally:
+            self.driver.deferred = deferred
+
+    def queue_rw(self, rw, wr):
+        f = future()
+        rd = bits.bytebits()
+        # leave the read outstanding until flush()
+        self.batch(rw, wr, rd)
+        self.later(lambda: f.set(rd))
+        return f
+
+    def queue_wr_ir(self, wr):
+        """queue an IR write for the device"""
+        self.batch(self.wr_ir, wr)
+
+    def queue_rw_ir(self, wr):
+        """queue an IR read/write for the device, return a future for the read data"""
+        return self.queue_rw(self.rw_ir, wr)
+
+    def queue_wr_dr(self, wr):
+        """queue a DR write for the device"""
+        self.batch(self.wr_dr, wr)
+
+    def queue_rw_dr(self, wr):
+        """queue a DR read/write for the device, return a future for the read data"""
+        return self.queue_rw(self.rw_dr, wr)
+
+    def flush(self):
+        """do the queued scans, the futures of the queued reads are then done"""
+        self.sync()
+
+    def later(self, fn):
+        """call fn once the read data for the queued scans is available"""
+        if self.driver.queued:
+            self.driver.later(fn)
+        else:
+            fn()
+
+    def sync(self):
+        """complete any scans queued by the driver"""
+        if self.driver.queued:
+            self.driver.sync()
 
     def __str__(self):
         """return a string describing the jtag chain"""
@@ -190,6 +372,8 @@ class jtag:
         if self.ndevs > 1:
             s.append('chain: %d devices, %d before %d after' % (self.ndevs, self.ndevs_before, self.ndevs_after))
             s.append('chain: %d ir bits total, %d before %d after' % (self.irlen_total, self.irlen_before, self.irlen_after))
+        if self.driver.frequency:
+            s.append('tck: %.3f MHz' % (self.driver.frequency / 1e6))
         return '\n'.join(s)
 
 #-----------------------------------------------------------------------------
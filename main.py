@@ -14,6 +14,11 @@ import bitfile
 
 #------------------------------------------------------------------------------
 
+def main6():
+    b = busblaster.board()
+    b.tune()
+    print b
+
 def main5():
     b = busblaster.board()
     print b
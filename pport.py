@@ -6,18 +6,45 @@ Parallel Port IO for a bitbang JTAG
 This is a slow interface - with a simple loop the maximum observed
 clock rate for any IO pin is around 150KHz
 
+The *_seq and *_sample functions take a whole buffer of port values.
+With the Linux ppdev backend of pyparallel they go straight to the ioctls,
+so the per byte cost is one ioctl and not a stack of python calls.
+
 """
 #-----------------------------------------------------------------------------
 
-import parallel
+import time
+
+try:
+    import parallel
+except ImportError:
+    # fake_io still works
+    parallel = None
+
+try:
+    import fcntl
+    from parallel import parallelppdev as _ppdev
+except ImportError:
+    _ppdev = None
+
+#-----------------------------------------------------------------------------
+
+class Error(Exception):
+    pass
 
 #-----------------------------------------------------------------------------
 
 class io:
 
     def __init__(self, port):
+        if parallel is None:
+            raise Error, 'pyparallel is not installed'
         self.p = parallel.Parallel(port)
         self.p.PPDATADIR(True)
+        # the ppdev file descriptor (None for other backends)
+        self.fd = None
+        if _ppdev is not None:
+            self.fd = getattr(self.p, '_fd', None)
 
     def rd_ctrl(self, b):
         """read ctrl byte"""
@@ -35,7 +62,110 @@ class io:
         """read status byte"""
         return self.p.PPRSTATUS()
 
+    def write_seq(self, req, wr, buf):
+        """write a buffer of values with the ioctl req (or the wr function)"""
+        if self.fd is None:
+            for b in buf:
+                wr(b)
+            return
+        ioctl = fcntl.ioctl
+        fd = self.fd
+        for c in str(buf):
+            ioctl(fd, req, c)
+
+    def write_sample(self, req, wr, buf, step):
+        """write a buffer of values, read the status after every step values, return the status values"""
+        status = bytearray()
+        if self.fd is None:
+            rd = self.rd_status
+            for (i, b) in enumerate(buf):
+                wr(b)
+                if (i + 1) % step == 0:
+                    status.append(rd())
+            return status
+        ioctl = fcntl.ioctl
+        fd = self.fd
+        rd_req = _ppdev.PPRSTATUS
+        i = step
+        for c in str(buf):
+            ioctl(fd, req, c)
+            i -= 1
+            if i == 0:
+                status.extend(ioctl(fd, rd_req, '\x00'))
+                i = step
+        return status
+
+    def write_data_seq(self, buf):
+        """write a buffer of data bytes"""
+        self.write_seq(_ppdev and _ppdev.PPWDATA, self.wr_data, buf)
+
+    def write_ctrl_seq(self, buf):
+        """write a buffer of ctrl bytes"""
+        self.write_seq(_ppdev and _ppdev.PPWCONTROL, self.wr_ctrl, buf)
+
+    def write_data_sample(self, buf, step = 1):
+        """write a buffer of data bytes, read the status after every step bytes, return the status bytes"""
+        return self.write_sample(_ppdev and _ppdev.PPWDATA, self.wr_data, buf, step)
+
+    def write_ctrl_sample(self, buf, step = 1):
+        """write a buffer of ctrl bytes, read the status after every step bytes, return the status bytes"""
+        return self.write_sample(_ppdev and _ppdev.PPWCONTROL, self.wr_ctrl, buf, step)
+
     def __str__(self):
         return self.p.device
 
 #-----------------------------------------------------------------------------
+
+class fake_io(io):
+    """
+    In-memory parallel port with the same interface (for testing and benchmarks).
+    The written values are kept in self.data and self.ctrl.
+    status(data, ctrl) returns the status byte for the current port values.
+    """
+
+    def __init__(self, status = None):
+        self.fd = None
+        self.data = bytearray()
+        self.ctrl = bytearray()
+        self.status = status
+
+    def wr_ctrl(self, b):
+        """write ctrl byte"""
+        self.ctrl.append(b)
+
+    def wr_data(self, b):
+        """write data byte"""
+        self.data.append(b)
+
+    def rd_status(self):
+        """read status byte"""
+        if self.status is None:
+            return 0
+        data = ctrl = 0
+        if self.data:
+            data = self.data[-1]
+        if self.ctrl:
+            ctrl = self.ctrl[-1]
+        return self.status(data, ctrl)
+
+    def write_data_seq(self, buf):
+        """write a buffer of data bytes"""
+        self.data.extend(buf)
+
+    def write_ctrl_seq(self, buf):
+        """write a buffer of ctrl bytes"""
+        self.ctrl.extend(buf)
+
+    def __str__(self):
+        return 'fake parallel port'
+
+#-----------------------------------------------------------------------------
+
+def benchmark(p, n = 1 << 16):
+    """return the write_data_seq() rate of a port in bytes/second"""
+    buf = bytearray([i & 0xff for i in xrange(n)])
+    t = time.time()
+    p.write_data_seq(buf)
+    return n / max(time.time() - t, 1e-9)
+
+#-----------------------------------------------------------------------------
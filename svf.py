@@ -5,8 +5,10 @@ SVF File Interpreter
 """
 #------------------------------------------------------------------------------
 
-import time
+import math
 import os
+import re
+import hashlib
 
 import utils
 import bits
@@ -19,52 +21,155 @@ class Error(Exception):
 
 #------------------------------------------------------------------------------
 
+_CHUNK_SIZE = 64 << 10 # file read size for the tokenizer
+
+# compiled svf cache
+_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.pyxs', 'svf')
+_CACHE_VERSION = 4
+_CACHE_MAGIC = 'SVFC%d' % _CACHE_VERSION
+
+# compiled svf opcodes (states are tap.py integer states)
+_OP_SIR = 0         # (op, line, n, tdi, tdo, mask)
+_OP_SDR = 1         # (op, line, n, tdi, tdo, mask)
+_OP_ENDIR = 2       # (op, line, state)
+_OP_ENDDR = 3       # (op, line, state)
+_OP_STATE = 4       # (op, line, (state, state, ...))
+_OP_RUNTEST = 5     # (op, line, run_state, count, unit, min_time, max_time, end_state)
+_OP_TRST = 6        # (op, line, on)
+_OP_FREQUENCY = 7   # (op, line, hz), hz is None for full speed
+
+_MAX_CHECKS = 1024 # deferred tdo checks are done in batches of this size
+
+_stable_states = ('RESET', 'IDLE', 'DRPAUSE', 'IRPAUSE')
+
+# hex data in parentheses may be split across lines
+_paren_re = re.compile(r'\(([^)]*)\)')
+
+def _unsplit(m):
+    return '(%s)' % ''.join(m.group(1).split())
+
+def _lines(f, chunk_size):
+    """generate the lines of a file read in chunks"""
+    carry = []
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        if '\n' not in chunk:
+            carry.append(chunk)
+            continue
+        carry.append(chunk)
+        lines = ''.join(carry).split('\n')
+        carry = [lines.pop()]
+        for l in lines:
+            yield l
+    if carry:
+        yield ''.join(carry)
+
+def commands(f, chunk_size = _CHUNK_SIZE):
+    """
+    generate (line number, command) tuples from an svf file object
+    comments are removed, multi-line commands are joined,
+    the line number is the line on which the command starts
+    """
+    line = 0
+    start = 0
+    partial = []
+    for l in _lines(f, chunk_size):
+        line += 1
+        # strip comments
+        i = l.find('//')
+        if i >= 0:
+            l = l[:i]
+        i = l.find('!')
+        if i >= 0:
+            l = l[:i]
+        pieces = l.split(';')
+        for (i, piece) in enumerate(pieces):
+            piece = piece.strip()
+            if piece:
+                if not partial:
+                    start = line
+                partial.append(piece)
+            if i == len(pieces) - 1:
+                # no terminating ';' yet
+                break
+            if not partial:
+                continue
+            if len(partial) == 1:
+                cmd = partial[0]
+            else:
+                cmd = _paren_re.sub(_unsplit, ' '.join(partial))
+            partial = []
+            yield (start, cmd)
+    if partial:
+        raise Error, 'line %d: unterminated command' % start
+
+#------------------------------------------------------------------------------
+
 class svf:
 
-    def __init__(self, filename, jtag):
+    def __init__(self, filename, jtag, deferred = False):
+        """
+        filename - svf file
+        jtag - jtag chain to play the svf file on
+        deferred - tdo checks are queued and done in batches, this lets the
+        driver queue read scans rather than doing a round trip per scan
+        """
         self.filename = filename
         self.jtag = jtag
+        self.deferred = deferred
         self.tck_period = 0.0
         self.mask = None
+        self.line = 0
+        self.checks = []
+
+    # compile: svf command -> (opcode, line, ...) tuple
+    # tdi/tdo/mask values are stored as lsb first byte strings
 
     def cmd_state(self, args):
         """transition through specific TAP states"""
         for state in args[1:]:
-            if not tap.state_machine.has_key(state):
+            if not tap.state_index.has_key(state):
                 raise Error, 'line %d: unknown jtag state %s' % (self.line, state)
-            if state == 'RESET':
-                # RESET requires a transition from any state
-                self.jtag.driver.state_reset()
-            else:
-                self.jtag.driver.state_x(state)
+        return (_OP_STATE, self.line, tuple([tap.state_index[state] for state in args[1:]]))
 
     def parse_tdi_tdo(self, args):
         """
         parse: length TDI (tdi) SMASK (smask) [TDO (tdo) MASK (mask)]
-        return the values in a dictionary
+        return (length, tdi, tdo, mask) with the values as byte strings
         """
-        vals = dict(zip(args[1::2], [utils.unparen(v) for v in args[2::2]]))
-        vals['NBITS'] = int(args[0])
+        vals = dict(zip(args[1::2], [v[1:-1] for v in args[2::2]]))
+        n = int(args[0])
         if not vals.has_key('TDI'):
             raise Error, 'line %d: missing TDI parameter' % self.line
-        return vals
-
-    def validate_tdo(self, tdo, vals):
-        """validate returned tdo bits against expectations"""
+        tdi = self.hex2bytes(n, vals['TDI'])
+        tdo = None
         if vals.has_key('TDO'):
-            n = vals['NBITS']
-            tdo_expected = bits.bits(n, vals['TDO'])
+            tdo = self.hex2bytes(n, vals['TDO'])
             if vals.has_key('MASK'):
                 # new tdo mask value
-                self.mask = bits.bits(n, vals['MASK'])
+                self.mask = (n, self.hex2bytes(n, vals['MASK']))
             else:
                 # validate old tdo mask value
                 if self.mask is None:
                     raise Error, 'line %d: no mask value set for tdo' % self.line
-                if len(self.mask) != n:
+                if self.mask[0] != n:
                     raise Error, 'line %d: bad mask length for tdo' % self.line
-            if (tdo & self.mask) != (tdo_expected & self.mask):
-                raise Error, 'line %d: tdo actual/expected mismatch' % self.line
+        elif vals.has_key('MASK'):
+            self.mask = (n, self.hex2bytes(n, vals['MASK']))
+        if tdo is None:
+            return (n, tdi, None, None)
+        return (n, tdi, tdo, self.mask[1])
+
+    def hex2bytes(self, n, x):
+        """convert an n bit svf hex string to a byte string"""
+        b = bits.bytebits()
+        try:
+            b.set_hex(n, x)
+        except TypeError:
+            raise Error, 'line %d: bad hex value' % self.line
+        return b.tobytes()
 
     def cmd_todo(self, args):
         """command not implemented"""
@@ -80,70 +185,93 @@ class svf:
             raise Error, 'line %d: no support for non-zero %s length' % (self.line, args[0])
 
     def cmd_frequency(self, args):
-        if args[2] != 'HZ':
-            raise Error, 'line %d: unrecognized %s unit - "%s"' % (self.line, args[0], args[2])
-        self.tck_period = 1.0 / float(args[1])
+        """command: FREQUENCY [cycles HZ]"""
+        if len(args) == 1:
+            # full speed
+            return (_OP_FREQUENCY, self.line, None)
+        if len(args) != 3 or args[2] != 'HZ':
+            raise Error, 'line %d: unrecognized %s arguments' % (self.line, args[0])
+        try:
+            hz = float(args[1])
+        except ValueError:
+            hz = 0.0
+        if hz <= 0.0:
+            raise Error, 'line %d: bad %s value - "%s"' % (self.line, args[0], args[1])
+        return (_OP_FREQUENCY, self.line, hz)
 
     def cmd_sir(self, args):
         """command: SIR length TDI (tdi) SMASK (smask) [TDO (tdo) MASK (mask)]"""
-        vals = self.parse_tdi_tdo(args[1:])
-        tdi = bits.bits(vals['NBITS'], vals['TDI'])
-        if vals.has_key('TDO'):
-            tdo = bits.bits()
-            self.jtag.rw_ir(tdi, tdo)
-            self.validate_tdo(tdo, vals)
-        else:
-            self.jtag.wr_ir(tdi)
+        return (_OP_SIR, self.line) + self.parse_tdi_tdo(args[1:])
 
     def cmd_sdr(self, args):
         """command: SDR length TDI (tdi) SMASK (smask) [TDO (tdo) MASK (mask)]"""
-        vals = self.parse_tdi_tdo(args[1:])
-        tdi = bits.bits(vals['NBITS'], vals['TDI'])
-        if vals.has_key('TDO'):
-            tdo = bits.bits()
-            self.jtag.rw_dr(tdi, tdo)
-            self.validate_tdo(tdo, vals)
-        else:
-            self.jtag.wr_dr(tdi)
+        return (_OP_SDR, self.line) + self.parse_tdi_tdo(args[1:])
 
     def cmd_enddr(self, args):
         """specify the ending TAP state for the sdr command"""
         if not (args[1] in ('IDLE', 'DRPAUSE')):
             raise Error, 'line %d: unrecognized %s value - "%s"' % (self.line, args[0], args[1])
-        self.jtag.driver.sdr_end_state = args[1]
+        return (_OP_ENDDR, self.line, tap.state_index[args[1]])
 
     def cmd_endir(self, args):
         """specify the ending TAP state for the sir command"""
         if not (args[1] in ('IDLE', 'IRPAUSE')):
             raise Error, 'line %d: unrecognized %s value - "%s"' % (self.line, args[0], args[1])
-        self.jtag.driver.sir_end_state = args[1]
+        return (_OP_ENDIR, self.line, tap.state_index[args[1]])
 
     def cmd_runtest(self, args):
-        """command: RUNTEST [state] run_count TCK"""
-        if len(args) == 4:
-            # RUNTEST state run_count TCK
-            state = args[1]
-            count = int(args[2])
-            unit = args[3]
-        elif len(args) == 3:
-            # RUNTEST run_count TCK
-            state = 'IDLE'
-            count = int(args[1])
-            unit = args[2]
-        else:
-            raise Error, 'line %d: bad number of arguments' % self.line
-        if unit != 'TCK':
-            raise Error, 'line %d: unrecognized %s unit - "%s"' % (self.line, args[0], unit)
-        self.jtag.driver.state_x(state)
-        time.sleep(2.0 * self.tck_period * count)
+        """
+        command: RUNTEST [run_state] run_count TCK|SCK [min_time SEC [MAXIMUM max_time SEC]] [ENDSTATE end_state]
+        command: RUNTEST [run_state] min_time SEC [MAXIMUM max_time SEC] [ENDSTATE end_state]
+        """
+        a = args[1:]
+        run_state = None
+        end_state = None
+        count = 0
+        unit = 'TCK'
+        min_time = 0.0
+        max_time = None
+        if a and a[0] in _stable_states:
+            run_state = tap.state_index[a.pop(0)]
+        has_count = len(a) >= 2 and a[1] in ('TCK', 'SCK')
+        try:
+            if has_count:
+                count = int(a[0])
+                unit = a[1]
+                a = a[2:]
+            has_time = len(a) >= 2 and a[1] == 'SEC'
+            if has_time:
+                min_time = float(a[0])
+                a = a[2:]
+                if len(a) >= 3 and a[0] == 'MAXIMUM' and a[2] == 'SEC':
+                    max_time = float(a[1])
+                    a = a[3:]
+        except ValueError:
+            raise Error, 'line %d: bad %s value' % (self.line, args[0])
+        if len(a) == 2 and a[0] == 'ENDSTATE':
+            if not a[1] in _stable_states:
+                raise Error, 'line %d: unrecognized %s end state - "%s"' % (self.line, args[0], a[1])
+            end_state = tap.state_index[a[1]]
+            a = a[2:]
+        if a or not (has_count or has_time):
+            raise Error, 'line %d: bad %s arguments' % (self.line, args[0])
+        if unit == 'SCK' and not has_time:
+            raise Error, 'line %d: no support for SCK run counts without a minimum time' % self.line
+        # run_state and end_state persist, end_state defaults to a given run_state
+        if run_state is not None:
+            self.run_state = run_state
+            self.end_state = run_state
+        if end_state is not None:
+            self.end_state = end_state
+        return (_OP_RUNTEST, self.line, self.run_state, count, unit, min_time, max_time, self.end_state)
 
     def cmd_trst(self, args):
         if not (args[1] in ('OFF', 'ON')):
             raise Error, 'line %d: unrecognized %s value - "%s"' % (self.line, args[0], args[1])
-        self.jtag.driver.test_reset(args[1] == 'ON')
+        return (_OP_TRST, self.line, args[1] == 'ON')
 
     def process_cmd(self, cmd):
-        """process a command"""
+        """compile a command, return an op tuple (or None)"""
         funcs = {
             'SDR': self.cmd_sdr,
             'HDR': self.cmd_chain,
@@ -161,28 +289,248 @@ class svf:
         cmd = cmd.rstrip(';')
         args = cmd.split()
         #print('line %d: %s' % (self.line, ' '.join(args)))
-        funcs.get(args[0], self.cmd_unknown)(args)
+        return funcs.get(args[0], self.cmd_unknown)(args)
+
+    def compile(self, f):
+        """generate the ops for an svf file object"""
+        self.mask = None
+        self.run_state = tap.IDLE
+        self.end_state = tap.IDLE
+        for (self.line, cmd) in commands(f):
+            op = self.process_cmd(cmd)
+            if op is not None:
+                yield op
+
+    # execute: run an op tuple on the jtag chain
+
+    def goto_state(self, state):
+        """move the TAP to a state"""
+        if state == tap.RESET:
+            # RESET requires a transition from any state
+            self.jtag.driver.state_reset()
+        else:
+            self.jtag.driver.state_x(state)
+
+    def op_state(self, op):
+        for state in op[2]:
+            self.goto_state(state)
+
+    def op_scan(self, op, wr, rw):
+        (n, tdi, tdo) = op[2:5]
+        wr_bits = bits.bytebits()
+        wr_bits.set(n, bytearray(tdi))
+        if tdo is None:
+            wr(wr_bits)
+        else:
+            rd_bits = bits.bytebits()
+            rw(wr_bits, rd_bits)
+            # the read data may be queued by the driver
+            if self.deferred:
+                self.jtag.later(lambda: self.queue_check(rd_bits, op))
+            else:
+                self.jtag.later(lambda: self.validate_tdo(rd_bits, op))
+
+    def queue_check(self, tdo, op):
+        """queue a tdo check"""
+        self.checks.append((tdo, op))
+        if len(self.checks) >= _MAX_CHECKS:
+            self.check_tdo()
+
+    def check_tdo(self):
+        """do the queued tdo checks, report the first mismatch"""
+        checks = self.checks
+        self.checks = []
+        for (tdo, op) in checks:
+            self.validate_tdo(tdo, op)
+
+    def validate_tdo(self, tdo, op):
+        """validate returned tdo bits against expectations"""
+        (n, tdi, tdo_expected, mask) = op[2:6]
+        x = bits.bytebits()
+        x.set(n, bytearray(tdo_expected))
+        m = bits.bytebits()
+        m.set(n, bytearray(mask))
+        if (tdo & m) != (x & m):
+            raise Error, 'line %d: tdo actual/expected mismatch' % op[1]
+
+    def op_sir(self, op):
+        self.op_scan(op, self.jtag.wr_ir, self.jtag.rw_ir)
+
+    def op_sdr(self, op):
+        self.op_scan(op, self.jtag.wr_dr, self.jtag.rw_dr)
+
+    def op_enddr(self, op):
+        self.jtag.driver.sdr_end_state = op[2]
+
+    def op_endir(self, op):
+        self.jtag.driver.sir_end_state = op[2]
+
+    def op_runtest(self, op):
+        (run_state, count, unit, min_time, max_time, end_state) = op[2:8]
+        driver = self.jtag.driver
+        self.goto_state(run_state)
+        if unit == 'TCK':
+            # the run count takes at least this long at the svf frequency
+            min_time = max(min_time, count * self.tck_period)
+            if max_time is not None and driver.frequency:
+                if float(count) / driver.frequency > max_time:
+                    raise Error, 'line %d: %d TCK exceeds the maximum time' % (op[1], count)
+        else:
+            # we don't have the system clock, wait for min_time
+            count = 0
+        if driver.idle_clock and driver.frequency:
+            # clocking is cheap - clock for the whole wait
+            count = max(count, int(math.ceil(min_time * driver.frequency)))
+        # the driver clocks and waits for whatever of min_time the clocks don't take
+        driver.clock(count, min_time)
+        self.goto_state(end_state)
+
+    def delay(self, secs):
+        """wait for secs seconds (after any commands queued by the driver)"""
+        self.jtag.driver.delay(secs)
+
+    def op_trst(self, op):
+        self.jtag.driver.test_reset(op[2])
+
+    def op_frequency(self, op):
+        driver = self.jtag.driver
+        if op[2] is None:
+            self.tck_period = 0.0
+            if driver.max_frequency:
+                driver.set_frequency(driver.max_frequency)
+        else:
+            self.tck_period = 1.0 / op[2]
+            driver.set_frequency(op[2])
+
+    def execute(self, op):
+        """execute an op"""
+        funcs = {
+            _OP_SIR: self.op_sir,
+            _OP_SDR: self.op_sdr,
+            _OP_ENDIR: self.op_endir,
+            _OP_ENDDR: self.op_enddr,
+            _OP_STATE: self.op_state,
+            _OP_RUNTEST: self.op_runtest,
+            _OP_TRST: self.op_trst,
+            _OP_FREQUENCY: self.op_frequency,
+        }
+        self.line = op[1]
+        funcs[op[0]](op)
+
+    def start(self):
+        """start playback"""
+        self.checks = []
+        # batch the commands (and leave the reads outstanding) if the driver can
+        self.jtag.driver.deferred = self.deferred and self.jtag.driver.queued
+
+    def stop(self):
+        """stop playback - the driver goes back to doing the commands as they come"""
+        self.jtag.driver.deferred = False
+
+    def finish(self):
+        """finish playback - complete any queued scans and tdo checks"""
+        self.stop()
+        self.jtag.sync()
+        self.check_tdo()
 
     def playback(self):
         """playback an svf file through the jtag device"""
         f = open(self.filename, 'r')
-        lines = f.readlines()
-        f.close()
         self.line = 0
-        progress = utils.progress(300, len(lines))
-        partial = ''
-        for l in lines:
-            self.line += 1
-            l = l.strip()
-            if l.startswith('//') or len(l) == 0:
-                continue
-            cmd = ''.join((partial, l))
-            if cmd.endswith(';'):
-                self.process_cmd(cmd)
-                partial = ''
+        progress = utils.progress(300, os.path.getsize(self.filename))
+        self.start()
+        try:
+            for op in self.compile(f):
+                self.execute(op)
+                progress.update(f.tell())
+            self.finish()
+        finally:
+            f.close()
+            self.stop()
+        progress.erase()
+
+    # compiled svf files
+
+    def cache_name(self):
+        """return the cache file name for the svf file"""
+        path = os.path.abspath(self.filename)
+        return os.path.join(_CACHE_DIR, '%s.svfc' % hashlib.sha1(path).hexdigest())
+
+    def content_hash(self):
+        """return the sha1 hash of the svf file contents"""
+        h = hashlib.sha1()
+        f = open(self.filename, 'rb')
+        try:
+            while True:
+                chunk = f.read(_CHUNK_SIZE)
+                if not chunk:
+                    break
+                h.update(chunk)
+        finally:
+            f.close()
+        return h.hexdigest()
+
+    def load_compiled(self):
+        """return the cached ops for the svf file, or None"""
+        x = utils.load_marshal(self.cache_name(), _CACHE_MAGIC)
+        if x is None:
+            return None
+        (mtime, size, digest, ops) = x
+        try:
+            st = os.stat(self.filename)
+            touched = (mtime, size) != (st.st_mtime, st.st_size)
+            if touched and digest != self.content_hash():
+                # the content has changed
+                return None
+        except (IOError, OSError):
+            return None
+        if touched:
+            # same content, refresh the cache header
+            self.save_compiled(ops)
+        return ops
+
+    def save_compiled(self, ops):
+        """write the ops for the svf file to the cache"""
+        st = os.stat(self.filename)
+        x = (st.st_mtime, st.st_size, self.content_hash(), ops)
+        utils.save_marshal(self.cache_name(), _CACHE_MAGIC, x)
+
+    def compiled(self):
+        """return the ops for the svf file, from the cache if possible"""
+        ops = self.load_compiled()
+        if ops is None:
+            f = open(self.filename, 'r')
+            try:
+                ops = tuple(self.compile(f))
+            finally:
+                f.close()
+            self.save_compiled(ops)
+        return ops
+
+    def playback_compiled(self):
+        """playback a compiled (and cached) svf file through the jtag device"""
+        ops = self.compiled()
+        driver = self.jtag.driver
+        self.start()
+        try:
+            if driver.recordable:
+                # compile the ops to the driver command stream, then play it
+                driver.record()
+                try:
+                    for op in ops:
+                        self.execute(op)
+                finally:
+                    program = driver.record_stop()
+                progress = utils.progress(300, len(program))
+                driver.play(program, progress)
             else:
-                partial = cmd
-            progress.update(self.line)
+                progress = utils.progress(300, len(ops))
+                for (i, op) in enumerate(ops):
+                    self.execute(op)
+                    progress.update(i)
+            self.finish()
+        finally:
+            self.stop()
         progress.erase()
 
 #------------------------------------------------------------------------------
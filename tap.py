@@ -7,6 +7,8 @@ Note:
 State names are taken from the SVF file specification.
 This keeps things simple when processing SVF files.
 
+States are integers, the tms sequences for all state transitions
+are built once (at import time) by a breadth first search.
 """
 #-----------------------------------------------------------------------------
 
@@ -29,61 +31,75 @@ state_machine = {
     'IRUPDATE': ('IDLE','DRSELECT'),
 }
 
-def search(path, current, dst):
-    """return the shortest state path linking src and dst states"""
-    # are we done?
-    if current == dst:
-        return path
-    # get the two outgoing states
-    (state0, state1) = state_machine[current]
-    # search paths with state0
-    if state0 in path:
-        # looping - not the shortest path
-        path0 = None
-    else:
-        path0 = list(path)
-        path0.append(state0)
-        path0 = search(path0, state0, dst)
-    # search paths with state1
-    if state1 in path:
-        # looping - not the shortest path
-        path1 = None
-    else:
-        path1 = list(path)
-        path1.append(state1)
-        path1 = search(path1, state1, dst)
-    # return the shortest path
-    if path0 is None:
-        return path1
-    if path1 is None:
-        return path0
-    return path0 if len(path0) < len(path1) else path1
-
-def tms(path, current):
-    """return a tms bit tuple from the current state along the path"""
-    s = []
-    for state in path:
-        s.append(state_machine[current].index(state))
-        current = state
-    return tuple(s)
+#-----------------------------------------------------------------------------
+# integer states
+
+names = (
+    'RESET', 'IDLE',
+    'DRSELECT', 'DRCAPTURE', 'DRSHIFT', 'DREXIT1', 'DRPAUSE', 'DREXIT2', 'DRUPDATE',
+    'IRSELECT', 'IRCAPTURE', 'IRSHIFT', 'IREXIT1', 'IRPAUSE', 'IREXIT2', 'IRUPDATE',
+)
+
+(RESET, IDLE,
+ DRSELECT, DRCAPTURE, DRSHIFT, DREXIT1, DRPAUSE, DREXIT2, DRUPDATE,
+ IRSELECT, IRCAPTURE, IRSHIFT, IREXIT1, IRPAUSE, IREXIT2, IRUPDATE) = range(len(names))
+
+# the state is unknown (only a reset will work)
+UNKNOWN = -1
+
+# state name -> state
+state_index = dict([(name, i) for (i, name) in enumerate(names)])
+
+# state -> (next state with tms = 0, next state with tms = 1)
+next_state = tuple([(state_index[state_machine[name][0]], state_index[state_machine[name][1]]) for name in names])
+
+# any state -> reset
+tms_reset = (1, 1, 1, 1, 1)
 
 #-----------------------------------------------------------------------------
 
-class tap(object):
-    """JTAG TAP State Machine"""
-
-    def __init__(self):
-        """build and cache all state transitions for fast lookup"""
-        self.cache = {}
-        states = state_machine.keys()
-        for src in states:
-            for dst in states:
-                path = search([], src, dst)
-                self.cache['%s->%s' % (src, dst)] = tms(path, src)
-        # any state to RESET
-        self.cache['*->RESET'] = (1,1,1,1,1)
-
-    def tms(self, src, dst):
-        return self.cache['%s->%s' % (src, dst)]
+def _distances(dst):
+    """return the shortest path length from each state to dst"""
+    # breadth first search back from dst
+    prev = [[] for s in names]
+    for (s, x) in enumerate(next_state):
+        for t in x:
+            prev[t].append(s)
+    dist = [None] * len(names)
+    dist[dst] = 0
+    todo = [dst]
+    for t in todo:
+        for s in prev[t]:
+            if dist[s] is None:
+                dist[s] = dist[t] + 1
+                todo.append(s)
+    return dist
+
+def _build():
+    """return the tms bit tuples for all src, dst state transitions"""
+    table = [[None] * len(names) for s in names]
+    for dst in range(len(names)):
+        dist = _distances(dst)
+        for src in range(len(names)):
+            tms = []
+            s = src
+            while s != dst:
+                # take a shortest path, tms = 1 wins a tie
+                bit = (0, 1)[dist[next_state[s][1]] == dist[s] - 1]
+                tms.append(bit)
+                s = next_state[s][bit]
+            table[src][dst] = tuple(tms)
+    return tuple([tuple(x) for x in table])
+
+# tms_table[src][dst] is the tms bit tuple for the src -> dst transition
+tms_table = _build()
+
+def tms(src, dst):
+    """return the tms bit tuple for the src -> dst transition"""
+    return tms_table[src][dst]
+
+def table(encode):
+    """return a transition table with the tms bit tuples packed by encode()"""
+    return tuple([tuple([encode(x) for x in row]) for row in tms_table])
 
 #-----------------------------------------------------------------------------
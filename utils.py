@@ -6,7 +6,9 @@ Utilities - small helper functions
 #------------------------------------------------------------------------------
 
 import sys
+import os
 import array
+import marshal
 
 #------------------------------------------------------------------------------
 
@@ -18,10 +20,45 @@ def unparen(x):
 
 def b2s(b):
     """convert bytes to a string"""
+    if isinstance(b, bytearray):
+        return str(b)
     return array.array('B', b).tostring()
 
 #------------------------------------------------------------------------------
 
+def load_marshal(name, magic):
+    """return the object in a file written by save_marshal(), or None"""
+    try:
+        f = open(name, 'rb')
+        try:
+            if f.read(len(magic)) != magic:
+                return None
+            return marshal.load(f)
+        finally:
+            f.close()
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+
+def save_marshal(name, magic, x):
+    """write an object to a file with marshal (failures are ignored, the files are caches)"""
+    try:
+        d = os.path.dirname(name)
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        # readers never see a partly written file
+        tmp = '%s.%d' % (name, os.getpid())
+        f = open(tmp, 'wb')
+        try:
+            f.write(magic)
+            marshal.dump(x, f)
+        finally:
+            f.close()
+        os.rename(tmp, name)
+    except (IOError, OSError):
+        pass
+
+#------------------------------------------------------------------------------
+
 def reverse8(x):
     """reverse a byte"""
     x = ((x & 0xaa) >> 1) | ((x & 0x55) << 1)
@@ -48,14 +48,17 @@ _CPLD_TMS = (1 << 2) # parallel port c2 - pin 16
 _CPLD_TDI = (1 << 3) # parallel port c3 - pin 17
 _CPLD_TDO_BIT = 7    # parallel port S7 - pin 11
 
+# status byte -> tdo bit
+_cpld_tdo = ''.join([chr(((i >> _CPLD_TDO_BIT) & 1) ^ 1) for i in range(256)])
+
 class cpld_jtag:
 
     def __init__(self, io):
         self.io = io
         self.io.wr_data(0)
 
-    def jtag_out(self, tck, tms, tdi = 0):
-        """set the tck, tms and tdi bits"""
+    def jtag_port(self, tck, tms, tdi = 0):
+        """return the port value for the tck, tms and tdi bits"""
         val = 0
         if not tck:
             val |= _CPLD_TCK
@@ -63,12 +66,22 @@ class cpld_jtag:
             val |= _CPLD_TMS
         if not tdi:
             val |= _CPLD_TDI
-        self.io.wr_ctrl(val)
+        return val
+
+    def jtag_out(self, tck, tms, tdi = 0):
+        """set the tck, tms and tdi bits"""
+        self.io.wr_ctrl(self.jtag_port(tck, tms, tdi))
 
     def jtag_in(self):
         """get the tdo bit"""
         return ((self.io.rd_status() >> _CPLD_TDO_BIT) & 1) ^ 1
 
+    def jtag_seq(self, seq, sample):
+        """write a sequence of port values, return the tdo bits sampled after every second value (if sample)"""
+        if sample:
+            return self.io.write_ctrl_sample(seq, 2).translate(_cpld_tdo)
+        self.io.write_ctrl_seq(seq)
+
     def test_reset(self, val):
         """control the test reset line"""
         # don't have a ~trst line
@@ -87,14 +100,17 @@ _FPGA_OE  = (1 << 3) # parallel port d3 - pin 5 (active lo)
 _FPGA_IE  = (1 << 4) # parallel port d4 - pin 6 (active hi)
 _FPGA_TDO_BIT = 4    # parallel port S4 - pin 13
 
+# status byte -> tdo bit
+_fpga_tdo = ''.join([chr((i >> _FPGA_TDO_BIT) & 1) for i in range(256)])
+
 class fpga_jtag:
 
     def __init__(self, io):
         self.io = io
         self.io.wr_data(_FPGA_IE)
 
-    def jtag_out(self, tck, tms, tdi = 0):
-        """set the tck, tms and tdi bits"""
+    def jtag_port(self, tck, tms, tdi = 0):
+        """return the port value for the tck, tms and tdi bits"""
         val = _FPGA_IE
         if tck:
             val |= _FPGA_TCK
@@ -102,12 +118,22 @@ class fpga_jtag:
             val |= _FPGA_TMS
         if tdi:
             val |= _FPGA_TDI
-        self.io.wr_data(val)
+        return val
+
+    def jtag_out(self, tck, tms, tdi = 0):
+        """set the tck, tms and tdi bits"""
+        self.io.wr_data(self.jtag_port(tck, tms, tdi))
 
     def jtag_in(self):
         """get the tdo bit"""
         return (self.io.rd_status() >> _FPGA_TDO_BIT) & 1
 
+    def jtag_seq(self, seq, sample):
+        """write a sequence of port values, return the tdo bits sampled after every second value (if sample)"""
+        if sample:
+            return self.io.write_data_sample(seq, 2).translate(_fpga_tdo)
+        self.io.write_data_seq(seq)
+
     def test_reset(self, val):
         """control the test reset line"""
         # don't have a ~trst line
@@ -124,6 +150,19 @@ class fpga_jtag:
 _FPGA_CCLK  = (1 << 0)  # parallel port d0
 _FPGA_PROGB = (1 << 7)  # parallel port d7
 _NYBBLE_SHIFT = 2       # parallel port d5,d4,d3,d2 - nybble data
+_SMAP_BLOCK = 1 << 16   # configuration bytes per port write block
+
+def _smap_values(x):
+    """return the 4 port values that clock a configuration byte to the fpga"""
+    x = utils.reverse8(x)
+    # upper nybble on falling edge of _FPGA_CCLK
+    hi = _FPGA_PROGB | (((x & 0xf0) >> 4) << _NYBBLE_SHIFT)
+    # lower nybble on rising edge of _FPGA_CCLK
+    lo = _FPGA_PROGB | ((x & 0x0f) << _NYBBLE_SHIFT)
+    return (hi | _FPGA_CCLK, hi, lo, lo | _FPGA_CCLK)
+
+# _smap_table[i] translates configuration bytes to the i-th of their 4 port values
+_smap_table = tuple([''.join([chr(_smap_values(x)[i]) for x in range(256)]) for i in range(4)])
 
 class fpga_smap:
 
@@ -151,6 +190,19 @@ class fpga_smap:
         val |= _FPGA_CCLK
         self.io.wr_data(val)
 
+    def wr_block(self, buf, progress = None):
+        """clock a buffer of configuration bytes to the fpga"""
+        buf = str(buf)
+        for ofs in xrange(0, len(buf), _SMAP_BLOCK):
+            block = buf[ofs:ofs + _SMAP_BLOCK]
+            # expand to the port values, 4 per byte
+            val = bytearray(4 * len(block))
+            for i in range(4):
+                val[i::4] = block.translate(_smap_table[i])
+            self.io.write_data_seq(val)
+            if progress:
+                progress.update(ofs + len(block))
+
     def finish(self):
         """finish the configuration process"""
         for i in range(8):
@@ -8,8 +8,13 @@ XSUSB JTAG Driver - JTAG via USB and a Microcontroller
 import logging
 import usb
 import time
+import re
+import threading
 
 import utils
+import bits
+import tap
+import driver
 
 #------------------------------------------------------------------------------
 
@@ -61,7 +66,19 @@ _TDI_VAL_MASK           = 0x10 # Static value for TDI if PUT_TDI_MASK is cleared
 _VID = 0x04d8
 _PID = 0xff8c
 
-_USB_TIMEOUT = 1000 # timeout in milliseconds
+_USB_TIMEOUT = 1000 # minimum timeout in milliseconds
+_USB_RATE = 200     # slowest expected transfer rate (bytes per millisecond)
+_CHUNK_SIZE = 4096  # big transfers are streamed in bulk transfers of this size
+
+_PACKET_SIZE = 64   # each command starts a new usb packet
+_BATCH_SIZE = 4096  # queued commands are sent once there are this many bytes
+_SEQ_BITS = 512     # scans up to this many clocks go as one TAP_SEQ with tms and tdi data
+_SEQ_READ_BITS = 8192 # or this many for read scans (saves a read of the last bit)
+_DIRECT_WRITE_SIZE = 4096 # tdi payloads of this size or more bypass the write buffer
+
+# constant tdi runs (bytes) in a write scan this long get their own static tdi TAP_SEQ
+_STATIC_MIN = 128
+_static_runs = re.compile('\x00{%d,}|\xff{%d,}' % (_STATIC_MIN, _STATIC_MIN))
 
 #------------------------------------------------------------------------------
 
@@ -83,6 +100,31 @@ def find_device(vid, pid, n):
 
 #------------------------------------------------------------------------------
 
+def _timeout(n):
+    """return the timeout (ms) for an n byte transfer"""
+    return _USB_TIMEOUT + n / _USB_RATE
+
+#------------------------------------------------------------------------------
+
+class usb_writer(threading.Thread):
+    """write a big buffer while the caller reads the response"""
+
+    def __init__(self, dev, ep, tx):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.dev = dev
+        self.ep = ep
+        self.tx = tx
+        self.error = None
+
+    def run(self):
+        try:
+            self.dev.bulk_write(self.ep, self.tx)
+        except Exception, e:
+            self.error = e
+
+#------------------------------------------------------------------------------
+
 class usb_dev:
 
     def __init__(self, n = 0):
@@ -96,12 +138,44 @@ class usb_dev:
         self.handle.resetEndpoint(usb.ENDPOINT_OUT + ep)
         self.handle.resetEndpoint(usb.ENDPOINT_IN + ep)
 
+    def bulk_write(self, ep, tx):
+        """write tx in chunks"""
+        n = len(tx)
+        for ofs in xrange(0, n, _CHUNK_SIZE):
+            # a view of the chunk, not a copy of it
+            k = min(n - ofs, _CHUNK_SIZE)
+            self.handle.bulkWrite(usb.ENDPOINT_OUT + ep, buffer(tx, ofs, k), _timeout(k))
+
+    def bulk_read(self, ep, n):
+        """read n bytes in chunks, stop early on a short transfer"""
+        rx = []
+        while len(rx) < n:
+            k = min(n - len(rx), _CHUNK_SIZE)
+            x = self.handle.bulkRead(usb.ENDPOINT_IN + ep, k, _timeout(k))
+            rx.extend(x)
+            if len(x) < k:
+                break
+        return rx
+
     def usb_txrx(self, ep, tx, rx_bytes = 0, check_cmd = False):
         """tx and/or rx usb packets"""
-        if tx and len(tx):
-            self.handle.bulkWrite(usb.ENDPOINT_OUT + ep, tx, _USB_TIMEOUT)
+        if tx and len(tx) > _CHUNK_SIZE and rx_bytes:
+            # read the response as the commands go out, the device
+            # stops taking commands once its response buffers are full
+            w = usb_writer(self, ep, tx)
+            w.start()
+            try:
+                rx = self.bulk_read(ep, rx_bytes)
+            finally:
+                w.join()
+            if w.error:
+                raise w.error
+        else:
+            if tx and len(tx):
+                self.bulk_write(ep, tx)
+            if rx_bytes:
+                rx = self.bulk_read(ep, rx_bytes)
         if rx_bytes:
-            rx = self.handle.bulkRead(usb.ENDPOINT_IN + ep, rx_bytes, _USB_TIMEOUT)
             if len(rx) != rx_bytes:
                 raise Error, 'received usb packet is too short'
             if check_cmd and (ord(tx[0]) != rx[0]):
@@ -142,82 +216,256 @@ class usb_ep:
 # tms bit sequences
 
 def _tms_bits(bits):
-    """convert a left to right bit string to an mpsee (len, bits) tuple"""
-    l = list(bits)
+    """convert a tms bit tuple to a (len, bits) tuple"""
+    x = 0
     # tms is shifted lsb first
-    l.reverse()
-    return (len(bits), int(''.join(l), 2) & 255)
+    for b in reversed(bits):
+        x = (x << 1) | b
+    return (len(bits), x)
+
+# _tms_table[src][dst] is the (len, bits) tms for the src -> dst transition
+_tms_table = tap.table(_tms_bits)
+_tms_reset = _tms_bits(tap.tms_reset)
 
-# pre-canned jtag state machine transitions
-_2reset = _tms_bits('11111') # any state -> reset
-_2rti = _tms_bits('111110')  # any state -> run-test/idle
-_rti2sir = _tms_bits('1100') # run-test/idle -> shift-ir
-_rti2sdr = _tms_bits('100')  # run-test/idle -> shift-dr
-_ex2rti = _tms_bits('10')    # exit-x -> run-test/idle
+#------------------------------------------------------------------------------
+
+def _tap_seq(n, flags):
+    """return the TAP_SEQ command header for n clocks"""
+    return bytearray((_CMD_TAP_SEQ, n & 0xff, (n >> 8) & 0xff, (n >> 16) & 0xff, (n >> 24) & 0xff, flags))
+
+def _static_tdi(val, n):
+    """return the _TDI_VAL_MASK flags if the n bits of val are constant, else None"""
+    val &= (1 << n) - 1
+    if val == 0:
+        return 0
+    if val == (1 << n) - 1:
+        return _TDI_VAL_MASK
+    return None
+
+def _interleave(tms, tdi):
+    """return the tms and tdi byte arrays interleaved a byte at a time"""
+    x = bytearray(len(tms) * 2)
+    x[0::2] = tms
+    x[1::2] = tdi
+    return x
 
 #------------------------------------------------------------------------------
 
-class jtag_driver:
+class jtag_driver(driver.jtag_driver):
+
+    # commands are batched into bulk writes
+    queued = True
+    # the firmware clocks tck for TAP_SEQ without the host
+    idle_clock = True
+    # and holds tdi at a static level
+    static_tdi = True
 
     def __init__(self, io):
         self.io = io
+        self.wrbuf = bytearray()
+        self.state_reset()
+        self.sir_end_state = tap.IDLE
+        self.sdr_end_state = tap.IDLE
 
-    def clock_tms(self, bits):
-        n = bits[0]
-        cmd = [_CMD_TAP_SEQ, n & 0xff, (n >> 8) & 0xff, (n >> 16) & 0xff, (n >> 24) & 0xff]
-        cmd.extend([_PUT_TDI_MASK | _PUT_TMS_MASK, bits[1], 0])
-        self.io.txrx(utils.b2s(cmd))
-
-    def shift_data(self, tdi, tdo):
+    def __del__(self):
+        self.flush()
+
+    def write(self, cmd, batch = True):
+        """queue a command (and any data in the same packets)"""
+        self.wrbuf.extend(cmd)
+        # pad to the end of the packet, the next command starts a new one
+        self.wrbuf.extend(bytearray(-len(self.wrbuf) % _PACKET_SIZE))
+        # commands that read are sent with the read (see read())
+        if batch and len(self.wrbuf) >= _BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """send the queued commands in one bulk write"""
+        if self.wrbuf:
+            self.io.txrx(buffer(self.wrbuf))
+            self.wrbuf = bytearray()
+
+    def done(self):
+        """end of an operation - send the queued commands unless they are being batched"""
+        if not self.deferred:
+            self.flush()
+
+    def read(self, n):
+        """send the queued commands and read n bytes of response"""
+        # one transfer, so big transfers are streamed both ways
+        tx = self.wrbuf
+        self.wrbuf = bytearray()
+        return self.io.txrx((None, buffer(tx))[len(tx) > 0], n)
+
+    def sync(self):
+        """send the queued commands"""
+        self.flush()
+
+    def clock_tms(self, tms):
+        """clock out a (len, bits) tms sequence"""
+        n = tms[0]
+        if n:
+            cmd = _tap_seq(n, _PUT_TDI_MASK | _PUT_TMS_MASK)
+            cmd.extend(_interleave(bits.bytebits(n, tms[1]).get(), bytearray((n + 7) >> 3)))
+            self.write(cmd)
+
+    def state_x(self, dst):
+        """change the TAP state from self.state to dst"""
+        self.clock_tms(_tms_table[self.state][dst])
+        self.state = dst
+        self.done()
+
+    def clock(self, n, secs = 0.0):
+        """clock tck n times in the current (stable) state, taking at least secs seconds"""
+        if n:
+            # static tms (1 holds the reset state, 0 holds the others), tdi = 0, no tdo
+            self.write(_tap_seq(n, (0, _TMS_VAL_MASK)[self.state == tap.RESET]))
+        if secs:
+            self.delay(secs)
+        else:
+            self.done()
+
+    def shift_data(self, shift, tdi, tdo, end_state):
         """
-        write (and possibly read) a bit stream from JTAG
+        move to a shift state, write (and possibly read) a bit stream and go to the end state
+        shift - the shift state (tap.IRSHIFT or tap.DRSHIFT)
         tdi - bit buffer of data to be written to the JTAG TDI pin
         tdo - bit buffer for the data read from the JTAG TDO pin (optional)
+        end_state - leave the TAP state machine in this state
         """
+        entry = _tms_table[self.state][shift]
+        # the last bit of data takes us to exit1 (the state after shift with tms = 1)
+        exit = _tms_table[tap.next_state[shift][1]][end_state]
+        self.state = end_state
         n = len(tdi)
-        cmd = [0, n & 0xff, (n >> 8) & 0xff, (n >> 16) & 0xff, (n >> 24) & 0xff]
-        if (tdi.val != 0) and (tdo is None):
-            cmd[0] = _CMD_TDI
-            self.io.txrx(utils.b2s(cmd))
-            self.io.txrx(utils.b2s(tdi.get()))
-        elif (tdi.val == 0) and (tdo is not None):
-            cmd[0] = _CMD_TDO
-            self.io.txrx(utils.b2s(cmd))
-            rx = self.io.txrx(None, (n + 7)/8)
-            tdo.set(n, rx)
-        elif (tdi.val != 0) and (tdo is not None):
-            cmd[0] = _CMD_TDI_TDO
-            self.io.txrx(utils.b2s(cmd))
-            rx = self.io.txrx(utils.b2s(tdi.get()), (n + 7)/8)
-            tdo.set(n, rx)
-        # exit-x -> run-test/idle
-        self.clock_tms(_ex2rti)
+        (e, x) = (entry[0], exit[0])
+        get = (0, _GET_TDO_MASK)[tdo is not None]
+        total = e + n + x
+        if total <= (_SEQ_BITS, _SEQ_READ_BITS)[tdo is not None]:
+            # a small scan - one TAP_SEQ with all the tms and tdi bits
+            val = tdi.val
+            tms = bits.bytebits(total, entry[1] | (1 << (e + n - 1)) | (exit[1] << (e + n)))
+            static = _static_tdi(val, n)
+            if static is None:
+                wr = bits.bytebits(total, val << e)
+                cmd = _tap_seq(total, _PUT_TDI_MASK | _PUT_TMS_MASK | get)
+                cmd.extend(_interleave(tms.get(), wr.get()))
+            else:
+                # constant tdi (the level doesn't matter outside the shift state)
+                cmd = _tap_seq(total, _PUT_TMS_MASK | static | get)
+                cmd.extend(tms.get())
+            self.write(cmd, not get)
+            if tdo is not None:
+                rd = bits.bytebits()
+                rd.set(total, bytearray(self.read((total + 7) >> 3)))
+                rd.drop_lsb(e)
+                rd.drop_msb(x)
+                tdo.set(n, rd.get())
+            else:
+                self.done()
+            return
+        # a big scan - the tdi data goes with static tms = 0
+        # then the last bit and the exit tms
+        self.clock_tms(entry)
+        if tdo is None and hasattr(tdi, 'segments'):
+            # write only - stream the segments
+            last = self.shift_segments(tdi)
+        elif tdo is None:
+            wr = tdi.get()
+            last = (wr[(n - 1) >> 3] >> ((n - 1) & 7)) & 1
+            self.shift_runs(wr, n - 1)
+        else:
+            wr = tdi.get()
+            last = (wr[(n - 1) >> 3] >> ((n - 1) & 7)) & 1
+            # one TAP_SEQ, so the tdo comes back in one read
+            static = _static_tdi(tdi.val, n - 1)
+            if static is None:
+                self.shift_tdi(wr, 0, n - 1, get)
+            else:
+                self.write(_tap_seq(n - 1, static | get), False)
+        cmd = _tap_seq(x + 1, _PUT_TDI_MASK | _PUT_TMS_MASK | get)
+        cmd.extend(_interleave(bits.bytebits(x + 1, 1 | (exit[1] << 1)).get(), bits.bytebits(x + 1, last).get()))
+        self.write(cmd, not get)
+        if tdo is not None:
+            rd = bits.bytebits()
+            rd.set(n - 1, bytearray(self.read((n + 6) >> 3)))
+            # the last bit goes on the msb end
+            val = bits.bytebits(1, self.read(1)[0] & 1)
+            val.append(rd)
+            tdo.set(n, val.get())
+        else:
+            self.done()
+
+    def shift_tdi(self, wr, ofs, n, get = 0):
+        """shift n bits of the byte array wr from byte ofs with static tms = 0"""
+        if n == 0:
+            return
+        nbytes = (n + 7) >> 3
+        cmd = _tap_seq(n, _PUT_TDI_MASK | get)
+        if get or nbytes < _DIRECT_WRITE_SIZE:
+            cmd.extend(buffer(wr, ofs, nbytes))
+            self.write(cmd, not get)
+            return
+        # a big write - fill the first packet, the rest of the
+        # data goes straight from wr in a transfer of its own
+        k = _PACKET_SIZE - len(cmd)
+        cmd.extend(buffer(wr, ofs, k))
+        self.write(cmd)
+        self.flush()
+        self.io.txrx(buffer(wr, ofs + k, nbytes - k))
+
+    def shift_runs(self, wr, n):
+        """shift the first n bits of the byte array wr, constant runs are sent without the data"""
+        ofs = 0
+        for m in _static_runs.finditer(wr, 0, n >> 3):
+            (i, j) = m.span()
+            self.shift_tdi(wr, ofs, (i - ofs) << 3)
+            self.write(_tap_seq((j - i) << 3, (0, _TDI_VAL_MASK)[wr[i] & 1]))
+            ofs = j
+        self.shift_tdi(wr, ofs, n - (ofs << 3))
+
+    def shift_segments(self, tdi):
+        """shift all but the last bit of a segmented bit stream (bits.rope) without joining it, return the last bit"""
+        segs = [s for s in tdi.segments()]
+        for (i, (n, bit, buf)) in enumerate(segs):
+            if i == len(segs) - 1:
+                # hold back the last bit for the exit tms
+                n -= 1
+            if bit is None:
+                wr = buf.get()
+                self.shift_runs(wr, n)
+            elif n:
+                # fills are never sent as data
+                self.write(_tap_seq(n, (0, _TDI_VAL_MASK)[bit]))
+        # the last bit of the stream is the msb of the last segment
+        if bit is None:
+            bit = (wr[n >> 3] >> (n & 7)) & 1
+        return bit
 
     def scan_ir(self, tdi, tdo = None):
         """write (and possibly read) a bit stream through the IR in the JTAG chain"""
-        ## run-test/idle -> shift-ir
-        self.clock_tms(_rti2sir)
-        self.shift_data(tdi, tdo)
+        self.shift_data(tap.IRSHIFT, tdi, tdo, self.sir_end_state)
 
     def scan_dr(self, tdi, tdo = None):
         """write (and possibly read) a bit stream through the DR in the JTAG chain"""
-        ## run-test/idle -> shift-dr
-        self.clock_tms(_rti2sdr)
-        self.shift_data(tdi, tdo)
+        self.shift_data(tap.DRSHIFT, tdi, tdo, self.sdr_end_state)
 
     def test_reset(self, val):
         """control the test reset line"""
         pass
 
     def state_reset(self):
-        """goto the reset state"""
-        # any state -> reset
-        self.clock_tms(_2reset)
+        """from *any* state go to the reset state"""
+        self.clock_tms(_tms_reset)
+        self.state = tap.RESET
+        self.done()
 
     def state_idle(self):
-        """goto the idle state"""
-        # any state -> run-test/idle
-        self.clock_tms(_2rti)
+        """from *any* state go to the run-test/idle state"""
+        self.clock_tms(_tms_reset)
+        self.clock_tms(_tms_table[tap.RESET][tap.IDLE])
+        self.state = tap.IDLE
+        self.done()
 
     def reset_jtag(self):
         """reset the TAP of all JTAG devices in the chain to the run-test/idle state"""